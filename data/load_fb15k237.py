@@ -1,7 +1,19 @@
+import gc
 import os
+import re
+import multiprocessing
+import numpy as np
 from kb import KB
 
-def load_fb15k(dir, with_text=True, split_text=False, max_vocab=-1):
+# approximate size of the chunks that files are parsed in by parallel loading
+CHUNK_BYTES = 1 << 24
+
+
+def load_fb15k(dir, with_text=True, split_text=False, max_vocab=-1, num_workers=0):
+    '''
+    :param num_workers: if > 0, triples (and text triples unless split_text) are parsed in this many processes,
+    see _load_triples_parallel
+    '''
     train_file = os.path.join(dir, "train.txt")
     test_file = os.path.join(dir, "test.txt")
     text_file = os.path.join(dir, "text_emnlp.txt")
@@ -9,6 +21,15 @@ def load_fb15k(dir, with_text=True, split_text=False, max_vocab=-1):
 
     kb = KB()
 
+    if num_workers > 0:
+        files = [(train_file, "train"), (valid_file, "valid"), (test_file, "test")]
+        if with_text and not split_text:
+            files.append((text_file, "train_text"))
+        _load_triples_parallel(files, kb, num_workers)
+        if with_text and split_text:
+            _load_dep_paths(text_file, kb, typ="train_text")
+        return kb
+
     _load_triples(train_file, kb)
     _load_triples(valid_file, kb, typ="valid")
     _load_triples(test_file, kb, typ="test")
@@ -46,56 +67,165 @@ def _load_triples(fn, kb, typ="train"):
     return triples
 
 
+def _chunks(fn, chunk_bytes=CHUNK_BYTES):
+    '''
+    :return: byte ranges (start, end) of about chunk_bytes that cover the file and start at the beginning of a line
+    '''
+    size = os.path.getsize(fn)
+    starts = [0]
+    with open(fn) as f:
+        while starts[-1] + chunk_bytes < size:
+            f.seek(starts[-1] + chunk_bytes)
+            f.readline()
+            if f.tell() >= size:
+                break
+            starts.append(f.tell())
+    return zip(starts, starts[1:] + [size])
+
+
+def _intern(keys):
+    '''
+    :return: distinct keys in order of their first occurrence and int32 array of the ids of keys
+    '''
+    ids = {}
+    key_ids = np.array([ids.setdefault(key, len(ids)) for key in keys], dtype=np.int32)
+    vocab = [None] * len(ids)
+    for key, i in ids.iteritems():
+        vocab[i] = key
+    return vocab, key_ids
+
+
+def _parse_chunk(job):
+    '''
+    Parses the lines of a chunk like _load_triples and interns their keys.
+    :param job: (file name, start, end)
+    :return: list with the keys of rel, subj and obj in order of their first occurrence in the chunk and int32 array
+    [num_lines, 3] of their ids
+    '''
+    fn, start, end = job
+    with open(fn) as f:
+        f.seek(start)
+        lines = f.read(end - start).split("\n")
+    rels, subjs, objs = [], [], []
+    for l in lines:
+        split = l.strip().split("\t")
+        if len(split) < 3:  # empty line at the end of the chunk
+            continue
+        rels.append(split[1])
+        subjs.append(split[0])
+        objs.append(split[2])
+    vocabs = []
+    ids = np.zeros([len(rels), 3], dtype=np.int32)
+    for dim, keys in enumerate((rels, subjs, objs)):
+        vocab, ids[:, dim] = _intern(keys)
+        vocabs.append(vocab)
+    return vocabs, ids
+
+
+def _load_triples_parallel(files, kb, num_workers):
+    '''
+    Same as _load_triples for every file in order. Files are split into chunks (see _chunks), which are parsed by
+    num_workers processes. Their vocabularies are merged in chunk order, so keys get the same ids as with
+    _load_triples, and all triples are added to the kb at once (see KB.add_id_facts).
+    :param files: list of (file name, typ)
+    '''
+    jobs = []
+    job_typs = []
+    for typ_id, (fn, _) in enumerate(files):
+        for start, end in _chunks(fn):
+            jobs.append((fn, start, end))
+            job_typs.append(typ_id)
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        parsed = pool.map(_parse_chunk, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    vocabs = [[], [], []]
+    ids = [{}, {}, {}]
+    chunk_ids = []
+    typ_ids = []
+    for typ_id, (chunk_vocabs, chunk_triples) in zip(job_typs, parsed):
+        merged = np.zeros(chunk_triples.shape, dtype=np.int64)
+        for dim in xrange(3):
+            # maps ids of the chunk to merged ids, only loops over the distinct keys of the chunk
+            chunk2merged = np.zeros([len(chunk_vocabs[dim])], dtype=np.int64)
+            for i, key in enumerate(chunk_vocabs[dim]):
+                j = ids[dim].get(key)
+                if j is None:
+                    j = len(vocabs[dim])
+                    ids[dim][key] = j
+                    vocabs[dim].append(key)
+                chunk2merged[i] = j
+            merged[:, dim] = chunk2merged[chunk_triples[:, dim]]
+        chunk_ids.append(merged)
+        typ_ids.append(np.full([len(merged)], typ_id, dtype=np.int64))
+    # creating millions of fact tuples would trigger the cyclic garbage collector again and again
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        kb.add_id_facts(True, [typ for _, typ in files], np.concatenate(typ_ids), vocabs, np.concatenate(chunk_ids))
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+# arcs of dependency paths, the lookahead also finds overlapping arcs, e.g., ">:<"
+_ARCS = re.compile(r"(?=(:<-|:<|>:))")
+# tokens of every relation that was split, see split_relations
+_split_cache = dict()
+
+
+def _split_dep_path(dep_path):
+    '''
+    Splits a dependency path at its arcs in a single scan. Arcs ":<-" and ":<" are kept as tokens, ">:" is not. The
+    placeholders [XXX] of both arguments are dropped, as is everything after the last arc.
+    >>> _split_dep_path("[XXX]:<-nsubj:<born>:prep>:in>:pobj>:[XXX]")
+    [':<-', 'nsubj', ':<', 'born', 'prep', 'in', 'pobj']
+    '''
+    tokens = []
+    c = 0
+    # arcs that start in the last two characters are ignored
+    last = len(dep_path) - 3
+    for m in _ARCS.finditer(dep_path):
+        i = m.start()
+        if i > last:
+            break
+        arc = m.group(1)
+        if c > 0:  # do not keep [XXX]
+            tokens.append(dep_path[c:i])
+        if arc != ">:":
+            tokens.append(arc)
+        c = i + len(arc)
+    return tokens
+
+
 def split_relations(rel):
-    if rel.endswith("_inv"):
-        split = split_relations(rel[:-4])
-        split.reverse()
-        return split
-    elif "[XXX]" in rel:
-        dep_path_arr = []
-        c = 0
-        for i in xrange(len(rel)-2):
-            if rel[i:i+3] == ":<-":
-                if c > 0:  # do not keep [XXX]
-                    dep_path_arr.append(rel[c:i])
-                dep_path_arr.append(":<-")
-                c = i+3
-            elif rel[i:i+2] == ":<":
-                if c > 0:
-                    dep_path_arr.append(rel[c:i])
-                dep_path_arr.append(":<")
-                c = i+2
-            elif rel[i:i+2] == ">:":
-                if c > 0:
-                    dep_path_arr.append(rel[c:i])
-                c = i+2
-        return dep_path_arr
-    else:
-        return [rel]  # rel.split("/")
+    '''
+    Splits dependency paths (see _split_dep_path), tokens of inverse relations are reversed, other relations are
+    single tokens. Tokens are memoized per relation, the same relations are split again and again.
+    :return: new list of tokens
+    >>> split_relations("[XXX]:<-nsubj:<born>:prep>:in>:pobj>:[XXX]_inv")
+    ['pobj', 'in', 'prep', 'born', ':<', 'nsubj', ':<-']
+    '''
+    split = _split_cache.get(rel)
+    if split is None:
+        if rel.endswith("_inv"):
+            split = tuple(reversed(split_relations(rel[:-4])))
+        elif "[XXX]" in rel:
+            split = tuple(_split_dep_path(rel))
+        else:
+            split = (rel,)  # rel.split("/")
+        _split_cache[rel] = split
+    return list(split)
 
 
 def _load_dep_paths(fn, kb, typ="train"):
     with open(fn) as f:
         for l in f:
             [id1, dep_path, id2, ct] = l.strip().split("\t")
-            dep_path_arr = []
-            c = 0
-            for i in xrange(len(dep_path)-2):
-                if dep_path[i:i+3] == ":<-":
-                    if c > 0:  # do not keep [XXX]
-                        dep_path_arr.append(dep_path[c:i])
-                    dep_path_arr.append(":<-")
-                    c = i+3
-                elif dep_path[i:i+2] == ":<":
-                    if c > 0:
-                        dep_path_arr.append(dep_path[c:i])
-                    dep_path_arr.append(":<")
-                    c = i+2
-                elif dep_path[i:i+2] == ">:":
-                    if c > 0:
-                        dep_path_arr.append(dep_path[c:i])
-                    c = i+2
-            kb.add(True, typ, dep_path_arr, id1, id2)
+            kb.add(True, typ, _split_dep_path(dep_path), id1, id2)
 
 
 ''' deprecated
@@ -0,0 +1,81 @@
+"""Checks that the tokenizer of load_fb15k237 splits relations exactly like the original character loop.
+Run from the repository root with: python -m data.test_load_fb15k237"""
+import doctest
+import random
+import unittest
+from data import load_fb15k237
+from data.load_fb15k237 import split_relations
+
+
+def reference_split_relations(rel):
+    '''
+    Original tokenizer, which slices substrings at every position.
+    '''
+    if rel.endswith("_inv"):
+        split = reference_split_relations(rel[:-4])
+        split.reverse()
+        return split
+    elif "[XXX]" in rel:
+        dep_path_arr = []
+        c = 0
+        for i in xrange(len(rel)-2):
+            if rel[i:i+3] == ":<-":
+                if c > 0:  # do not keep [XXX]
+                    dep_path_arr.append(rel[c:i])
+                dep_path_arr.append(":<-")
+                c = i+3
+            elif rel[i:i+2] == ":<":
+                if c > 0:
+                    dep_path_arr.append(rel[c:i])
+                dep_path_arr.append(":<")
+                c = i+2
+            elif rel[i:i+2] == ">:":
+                if c > 0:
+                    dep_path_arr.append(rel[c:i])
+                c = i+2
+        return dep_path_arr
+    else:
+        return [rel]
+
+
+# pieces of generated relations: arc separators, their characters, placeholders, suffixes and words
+PIECES = [":<-", ":<", ">:", ":", "<", "-", ">", "[XXX]", "_inv", "nsubj", "prep", "in", "x"]
+
+
+def random_relation(rng):
+    rel = "".join(rng.choice(PIECES) for _ in xrange(rng.randint(0, 12)))
+    if rng.random() < 0.7:
+        rel = "[XXX]" + rel
+    if rng.random() < 0.5:
+        rel += "[XXX]"
+    for _ in xrange(rng.randint(0, 2)):
+        rel += "_inv"
+    return rel
+
+
+class SplitRelationsTest(unittest.TestCase):
+
+    def test_matches_reference(self):
+        rng = random.Random(1234)
+        for _ in xrange(200000):
+            rel = random_relation(rng)
+            expected = reference_split_relations(rel)
+            self.assertEqual(split_relations(rel), expected, rel)
+            # memoized result must be the same and must not be shared with callers
+            result = split_relations(rel)
+            self.assertEqual(result, expected, rel)
+            result.append("modified")
+            self.assertEqual(split_relations(rel), expected, rel)
+
+    def test_dep_paths_match_reference(self):
+        rng = random.Random(4321)
+        for _ in xrange(20000):
+            dep_path = "[XXX]" + "".join(rng.choice(PIECES[:7]) for _ in xrange(rng.randint(0, 12))) + "[XXX]"
+            self.assertEqual(load_fb15k237._split_dep_path(dep_path), reference_split_relations(dep_path), dep_path)
+
+    def test_doctests(self):
+        self.assertEqual(doctest.testmod(load_fb15k237).failed, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,7 @@
 import numpy as np
 import sys
 import math
+import random
 
 
 def rank_triple(sess, kb, model, triple, position="obj"):
@@ -28,7 +29,8 @@ def rank_triple(sess, kb, model, triple, position="obj"):
                                                           not kb.contains_fact(True, "valid", rel, e, obj),
                                                           compatible))
 
-    scores = model.score_triples(sess, [triple] + neg_triples)
+    ids = np.array([kb.get_ids(*t) for t in [triple] + neg_triples], dtype=np.int64)
+    scores = model.score_ids(sess, ids[:, 0], ids[:, 1], ids[:, 2])
     ix = np.argsort(scores)[::-1]
     rank = np.where(ix == 0)[0][0] + 1
 
@@ -130,6 +132,110 @@ def eval_triples(sess, kb, model, triples, position="both", verbose=False):
     return (mrr, top10), (mrr_wt, top10_wt), (mrr_nt, top10_nt)
 
 
+def _is_filtered(kb, rel, subj, obj):
+    return kb.contains_fact(True, "train", rel, subj, obj) or \
+           kb.contains_fact(True, "test", rel, subj, obj) or \
+           kb.contains_fact(True, "valid", rel, subj, obj)
+
+
+def sample_eval_candidates(kb, triples, num_candidates, seed=1234, position="both"):
+    '''
+    Samples a fixed set of filtered negative candidates for every query once, so that approximate validation
+    ranks against the same candidates at every checkpoint.
+    :param num_candidates: max number of negative candidates per query
+    :return: list of (triple, position, negative triples)
+    '''
+    rng = random.Random(seed)
+    compatible_cache = dict()
+    queries = list()
+    positions = ["subj", "obj"] if position == "both" else [position]
+    for triple in triples:
+        (rel, subj, obj) = triple
+        for pos in positions:
+            dim = 2 if pos == "obj" else 1
+            true_arg = obj if pos == "obj" else subj
+            key = (dim, rel)
+            if key not in compatible_cache:
+                compatible_cache[key] = sorted(kb.compatible_args_of(dim, rel))
+            compatible = compatible_cache[key]
+            if true_arg not in kb.compatible_args_of(dim, rel):
+                queries.append((triple, pos, None))
+                continue
+
+            def corrupt(e):
+                return (rel, subj, e) if pos == "obj" else (rel, e, obj)
+
+            if len(compatible) <= 2 * num_candidates:
+                negs = [corrupt(e) for e in compatible if e != true_arg and not _is_filtered(kb, *corrupt(e))]
+                if len(negs) > num_candidates:
+                    negs = rng.sample(negs, num_candidates)
+            else:
+                # rejection sampling is much cheaper than filtering all compatible arguments
+                negs = list()
+                seen = set()
+                tries = 0
+                while len(negs) < num_candidates and tries < 10 * num_candidates:
+                    tries += 1
+                    e = compatible[rng.randint(0, len(compatible) - 1)]
+                    if e != true_arg and e not in seen:
+                        seen.add(e)
+                        if not _is_filtered(kb, *corrupt(e)):
+                            negs.append(corrupt(e))
+            queries.append((triple, pos, negs))
+    return queries
+
+
+def eval_triples_sampled(sess, kb, model, queries, verbose=False):
+    '''
+    Approximate evaluation on queries created by sample_eval_candidates. Ranks are computed against the sampled
+    candidates only, so MRR is biased upwards compared to eval_triples, but comparable across checkpoints.
+    :return: (mrr, top10, mrr_ci), (mrr_wt, top10_wt, mrr_ci_wt), (mrr_nt, top10_nt, mrr_ci_nt), where mrr_ci is the
+    half width of the 95% confidence interval of the MRR
+    '''
+    has_text_mention = set()
+    for (pred, subj, obj), _, _ in kb.get_all_facts_of_arity(2, "train_text"):
+        has_text_mention.add((subj, obj))
+        has_text_mention.add((obj, subj))
+
+    # score all candidates in as few full batches as possible
+    all_triples = list()
+    for triple, _, negs in queries:
+        if negs is not None:
+            all_triples.append(triple)
+            all_triples.extend(negs)
+    ids = np.array([kb.get_ids(*t) for t in all_triples], dtype=np.int64).reshape([-1, 3])
+    scores = model.score_ids(sess, ids[:, 0], ids[:, 1], ids[:, 2])
+
+    rr = np.zeros([len(queries)])
+    with_text = np.zeros([len(queries)], dtype=np.bool)
+    offset = 0
+    for i, (triple, _, negs) in enumerate(queries):
+        with_text[i] = (triple[1], triple[2]) in has_text_mention
+        if negs is not None:
+            query_scores = scores[offset:offset + len(negs) + 1]
+            offset += len(negs) + 1
+            rr[i] = 1.0 / (1 + np.sum(query_scores[1:] > query_scores[0]))
+
+    def stats(rrs):
+        if len(rrs) == 0:
+            return 0.0, 0.0, 0.0
+        ci = 1.96 * np.std(rrs, ddof=1) / math.sqrt(len(rrs)) if len(rrs) > 1 else 0.0
+        return np.mean(rrs), np.mean(rrs >= 0.1), ci
+
+    (mrr, top10, ci), (mrr_wt, top10_wt, ci_wt), (mrr_nt, top10_nt, ci_nt) = \
+        stats(rr), stats(rr[with_text]), stats(rr[~with_text])
+
+    if verbose:
+        print "Approximate MRR: %.3f +- %.3f" % (mrr, ci)
+        print "Approximate Top10: %.3f" % top10
+        print "Approximate MRR wt: %.3f +- %.3f" % (mrr_wt, ci_wt)
+        print "Approximate Top10 wt: %.3f" % top10_wt
+        print "Approximate MRR nt: %.3f +- %.3f" % (mrr_nt, ci_nt)
+        print "Approximate Top10 nt: %.3f" % top10_nt
+
+    return (mrr, top10, ci), (mrr_wt, top10_wt, ci_wt), (mrr_nt, top10_nt, ci_nt)
+
+
 if __name__ == "__main__":
     import os
     from data.load_fb15k237 import load_fb15k, load_fb15k_type_constraints
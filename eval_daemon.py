@@ -0,0 +1,159 @@
+"""Evaluates checkpoints written by train.py (--async_valid) out of band, so training does not block on
+validation. Results are appended as json lines to the metrics file in save_dir, which the trainer polls. Checkpoints
+that cannot be restored get a record with "skipped" set, so the trainer does not wait for them."""
+import os
+import re
+import json
+import time
+
+
+CONFIG_FILE = "config.json"
+VALID_FILE = "valid_subset.txt"
+METRICS_FILE = "valid_metrics.json"
+DONE_FILE = "done"
+
+
+# checkpoints written by train.py, the saver also writes temporary files like model.ckpt-N.tempstate<random>
+CHECKPOINT_PATTERN = re.compile(r"model\.ckpt-(\d+)$")
+
+
+def checkpoint_step(path):
+    return int(CHECKPOINT_PATTERN.match(os.path.basename(path)).group(1))
+
+
+def list_checkpoints(train_dir):
+    '''
+    :return: paths of all checkpoints in train_dir sorted by global step
+    '''
+    if not os.path.exists(train_dir):
+        return []
+    ckpts = [os.path.join(train_dir, x) for x in os.listdir(train_dir) if CHECKPOINT_PATTERN.match(x)]
+    return sorted(ckpts, key=checkpoint_step)
+
+
+def read_metrics(fn):
+    '''
+    :return: list of all complete metrics records in fn, in the order they were written
+    '''
+    records = []
+    if os.path.exists(fn):
+        with open(fn) as f:
+            for l in f:
+                if l.endswith("\n"):  # last line might still be written
+                    records.append(json.loads(l))
+    return records
+
+
+def append_metrics(fn, record):
+    with open(fn, "a") as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+        f.flush()
+
+
+def write_triples(fn, triples):
+    with open(fn, "w") as f:
+        for rel, subj, obj in triples:
+            f.write("%s\t%s\t%s\n" % (subj, rel, obj))
+
+
+def read_triples(fn):
+    triples = []
+    with open(fn) as f:
+        for l in f:
+            [subj, rel, obj] = l.strip().split("\t")
+            triples.append((rel, subj, obj))
+    return triples
+
+
+def watch(sess, kb, model, save_dir, valid_triples, valid_queries=None, poll_interval=10.0):
+    '''
+    Evaluates every new checkpoint in save_dir/train until the trainer marks training as done.
+    '''
+    from eval import eval_triples, eval_triples_sampled
+    train_dir = os.path.join(save_dir, "train")
+    metrics_file = os.path.join(save_dir, METRICS_FILE)
+    evaluated = set(r["path"] for r in read_metrics(metrics_file))
+    while True:
+        # check before listing so no checkpoint written before the done marker is missed
+        done = os.path.exists(os.path.join(train_dir, DONE_FILE))
+        todo = [p for p in list_checkpoints(train_dir) if p not in evaluated]
+        for path in todo:
+            try:
+                model.saver.restore(sess, path)
+            except Exception as e:
+                # checkpoint was probably removed by the saver of the trainer in the meantime
+                print("Skipping checkpoint %s: %s" % (path, e))
+                append_metrics(metrics_file, {"path": path, "global_step": checkpoint_step(path), "skipped": True})
+                evaluated.add(path)
+                continue
+            if hasattr(model, "reset_composition_cache"):
+                model.reset_composition_cache()
+            print("Evaluating checkpoint " + path)
+            start_time = time.time()
+            if valid_queries is not None:
+                (mrr, top10, ci), (mrr_wt, top10_wt, ci_wt), (mrr_nt, top10_nt, ci_nt) = \
+                    eval_triples_sampled(sess, kb, model, valid_queries, verbose=True)
+            else:
+                (mrr, top10), (mrr_wt, top10_wt), (mrr_nt, top10_nt) = \
+                    eval_triples(sess, kb, model, valid_triples, verbose=True)
+                ci, ci_wt, ci_nt = 0.0, 0.0, 0.0
+            append_metrics(metrics_file, {"path": path, "global_step": checkpoint_step(path),
+                                          "mrr": mrr, "top10": top10, "mrr_ci": ci,
+                                          "mrr_wt": mrr_wt, "top10_wt": top10_wt, "mrr_ci_wt": ci_wt,
+                                          "mrr_nt": mrr_nt, "top10_nt": top10_nt, "mrr_ci_nt": ci_nt,
+                                          "eval_time": time.time() - start_time})
+            evaluated.add(path)
+        if done and not todo:
+            break
+        if not todo:
+            time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    import tensorflow as tf
+    from data.load_fb15k237 import load_fb15k, load_fb15k_type_constraints
+    from eval import sample_eval_candidates
+    from model import create_model
+    from kb_index import KBIndexCache
+
+    tf.app.flags.DEFINE_string("save_dir", None, "save_dir of the training run to watch.")
+    tf.app.flags.DEFINE_string("fb15k_dir", None, "Overrides the data dir of the training run.")
+    tf.app.flags.DEFINE_float("poll_interval", 10.0, "Seconds to wait between looking for new checkpoints.")
+    tf.app.flags.DEFINE_integer("num_threads", 0, "Number of threads used by tensorflow. 0 means tensorflow default.")
+
+    FLAGS = tf.app.flags.FLAGS
+
+    with open(os.path.join(FLAGS.save_dir, CONFIG_FILE)) as f:
+        config = json.load(f)
+    if config["subsample_kb"] > 0:
+        raise ValueError("Evaluation daemon does not support subsampled kbs.")
+    fb15k_dir = FLAGS.fb15k_dir or config["fb15k_dir"]
+
+    kb = load_fb15k(fb15k_dir, with_text=not config["kb_only"])
+    if config["type_constraint"]:
+        load_fb15k_type_constraints(kb, os.path.join(fb15k_dir, "types"))
+    if config.get("index_cache"):
+        kb.index_cache = KBIndexCache(kb, config["index_cache"])
+    print("Loaded data.")
+
+    valid_triples = read_triples(os.path.join(FLAGS.save_dir, VALID_FILE))
+    valid_queries = None
+    if config.get("approx_valid_candidates", 0) > 0:
+        valid_queries = sample_eval_candidates(kb, valid_triples, config["approx_valid_candidates"],
+                                               seed=config["random_seed"])
+
+    model_type = config["model"]
+    if not isinstance(model_type, list) and "," in model_type:
+        model_type = model_type.split(",")
+    observed_sets = config["observed_sets"]
+    if not isinstance(observed_sets, list):
+        observed_sets = observed_sets.split(",")
+    batch_size = (config["num_neg"]+1) * config["pos_per_batch"] * 2
+
+    sess_config = tf.ConfigProto(intra_op_parallelism_threads=FLAGS.num_threads,
+                                 inter_op_parallelism_threads=FLAGS.num_threads)
+    with tf.Session(config=sess_config) as sess:
+        model = create_model(kb, config["size"], batch_size, is_train=False, num_neg=config["num_neg"],
+                             type=model_type, observed_sets=observed_sets, composition=config["composition"])
+        print("Created model: " + model.name())
+        watch(sess, kb, model, FLAGS.save_dir, valid_triples, valid_queries, FLAGS.poll_interval)
@@ -0,0 +1,80 @@
+"""Hogwild training: several threads run steps of the same model concurrently, without locking its variables."""
+import random
+import threading
+import time
+import numpy as np
+
+
+class HogwildTrainer:
+    '''
+    Every thread samples batches from its own samplers and feeds the model through step_ids, which builds a new
+    feed dict per call, so threads share nothing but the model variables.
+    '''
+
+    def __init__(self, sess, model, kb, thread_samplers, sample_text_prob=0.0, seed=1234):
+        '''
+        :param thread_samplers: list with one list of samplers per thread, [fact_sampler] or
+        [fact_sampler, text_sampler]. Samplers should have their own rng (see BatchNegTypeSampler).
+        :param sample_text_prob: probability of sampling a batch from the text sampler
+        '''
+        assert not hasattr(model, "_composition_forward"), "Hogwild training does not support compositional models."
+        self._sess = sess
+        self._model = model
+        self._kb = kb
+        self._thread_samplers = thread_samplers
+        self._sample_text_prob = sample_text_prob
+        self._rngs = [random.Random(seed + k) for k in xrange(len(thread_samplers))]
+        self._lock = threading.Lock()
+        self.num_threads = len(thread_samplers)
+        # total number of batches sampled from fact samplers, used for counting epochs
+        self.fact_batches = 0
+
+    def _batch_ids(self, pos, negs):
+        triples = []
+        for p, ns in zip(pos, negs):
+            triples.append(p)
+            triples.extend(ns)
+        return np.array([self._kb.get_ids(*t) for t in triples], dtype=np.int64)
+
+    def _work(self, k, stats):
+        try:
+            self._run_steps(k, stats)
+        except Exception as e:
+            stats["error"] = e
+
+    def _run_steps(self, k, stats):
+        samplers = self._thread_samplers[k]
+        rng = self._rngs[k]
+        start_time = time.time()
+        while True:
+            with self._lock:
+                if self._todo <= 0:
+                    break
+                self._todo -= 1
+            if len(samplers) == 1 or rng.random() >= self._sample_text_prob:
+                pos, negs = samplers[0].get_batch()
+                with self._lock:
+                    self.fact_batches += 1
+            else:
+                pos, negs = samplers[1].get_batch()
+            ids = self._batch_ids(pos, negs)
+            stats["loss"] += self._model.step_ids(self._sess, ids[:, 0], ids[:, 1], ids[:, 2])
+            stats["steps"] += 1
+        stats["time"] = time.time() - start_time
+
+    def run(self, num_steps):
+        '''
+        Runs num_steps steps in total, which are distributed dynamically across all threads.
+        :return: list of dicts with "steps", "loss" (summed) and "time" for each thread
+        '''
+        self._todo = num_steps
+        stats = [{"steps": 0, "loss": 0.0, "time": 0.0} for _ in xrange(self.num_threads)]
+        threads = [threading.Thread(target=self._work, args=(k, stats[k])) for k in xrange(self.num_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for s in stats:
+            if "error" in s:
+                raise s["error"]
+        return stats
@@ -5,6 +5,7 @@
 # Tim Rocktaeschel, Guillaume Bouchard
 
 import random
+import numpy as np
 import pandas as pd
 
 
@@ -80,6 +81,8 @@ class KB:
         self.__compatible_args = dict()
 
         self.__formulae = {}
+        # indexes derived from the facts, shared by all models (see kb_index.KBIndexCache)
+        self.index_cache = None
 
     def add_compatible_arg(self, key, dim, rel_key, rel_dim=0):
         '''
@@ -149,12 +152,78 @@ class KB:
         if not self.contains_fact(truth, typ, *keys):
             fact = (keys, truth, typ)
             self.__add_to_facts(fact)
+            self.index_cache = None
             for dim in range(len(keys)):
                 key = keys[dim]
                 self.__add_to_vocab(key, dim)
                 self.__add_to_symbols(key, dim)
                 self.__add_to_maps(key, dim, fact)
 
+    def add_id_facts(self, truth, typs, typ_ids, vocabs, ids):
+        '''
+        Adds many facts at once, e.g., parsed by data.load_fb15k237.load_fb15k with num_workers > 0. The KB ends up
+        the same as after calling add for every fact in order, but duplicates are found and facts are grouped by
+        symbol with numpy instead of fact by fact.
+        :param typs: list of types, which typ_ids refer to
+        :param typ_ids: int array with the type of every fact
+        :param vocabs: list with the keys of every dimension, which ids refer to
+        :param ids: int array [num_facts, num_dims]
+        '''
+        ids = np.asarray(ids, dtype=np.int64).reshape([len(typ_ids), len(vocabs)])
+        # id of every distinct (typ, key_0, ..., key_n), built up dimension by dimension so it does not overflow
+        fact_ids = np.asarray(typ_ids, dtype=np.int64)
+        for dim, vocab in enumerate(vocabs):
+            fact_ids = np.unique(fact_ids, return_inverse=True)[1] * len(vocab) + ids[:, dim]
+        # first occurrence of every distinct fact
+        keep = np.sort(np.unique(fact_ids, return_index=True)[1])
+        columns = []
+        for dim, vocab in enumerate(vocabs):
+            # keys can be tuples, which np.array would turn into another dimension
+            vocab_array = np.empty([len(vocab)], dtype=object)
+            for i, key in enumerate(vocab):
+                vocab_array[i] = key
+            columns.append(vocab_array[ids[keep, dim]].tolist())
+        typ_column = [typs[t] for t in np.asarray(typ_ids)[keep].tolist()]
+        facts = [(keys, truth, typ) for keys, typ in zip(zip(*columns), typ_column)]
+        if self.__all_facts:
+            new = [j for j, fact in enumerate(facts) if fact not in self.__all_facts]
+            keep = keep[new]
+            facts = [facts[j] for j in new]
+        if not facts:
+            return
+        ids = ids[keep]
+
+        arity = len(vocabs) - 1
+        self.__facts.setdefault(arity, list()).extend(facts)
+        self.__all_facts.update(facts)
+        self.index_cache = None
+        for dim, vocab in enumerate(vocabs):
+            if len(self.__vocab) <= dim:
+                self.__vocab.append(list())
+                self.__ids.append({})
+                self.__dims.append(0)
+            if len(self.__symbols) <= dim:
+                self.__symbols.append(set())
+            if len(self.__maps) <= dim:
+                self.__maps.append({})
+            # facts grouped by symbol, the sort is stable, so every group starts with the first fact of its symbol
+            order = np.argsort(ids[:, dim], kind="mergesort")
+            sorted_ids = ids[order, dim]
+            starts = np.concatenate([[0], np.where(np.diff(sorted_ids) != 0)[0] + 1])
+            ends = np.append(starts[1:], len(order))
+            sorted_facts = [facts[j] for j in order.tolist()]
+            # new symbols get ids in order of their first fact
+            group_order = np.argsort(order[starts])
+            for key_id, start, end in zip(sorted_ids[starts[group_order]].tolist(), starts[group_order].tolist(),
+                                          ends[group_order].tolist()):
+                key = vocab[key_id]
+                if key not in self.__symbols[dim]:
+                    self.__ids[dim][key] = len(self.__vocab[dim])
+                    self.__vocab[dim].append(key)
+                    self.__dims[dim] += 1
+                    self.__symbols[dim].add(key)
+                self.__maps[dim].setdefault(key, list()).extend(sorted_facts[start:end])
+
     def contains_fact(self, truth, typ, *keys):
         return (keys, truth, typ) in self.get_all_facts()
 
@@ -0,0 +1,245 @@
+"""Array based indexes over kb facts, which allow feature lookups for whole batches of ids at once."""
+import os
+import zlib
+import numpy as np
+
+
+def pack_pairs(first_ids, second_ids, num_second):
+    '''
+    :param num_second: upper bound (exclusive) of second_ids
+    :return: int64 keys which uniquely identify each (first, second) id pair
+    '''
+    return np.asarray(first_ids, dtype=np.int64) * num_second + np.asarray(second_ids, dtype=np.int64)
+
+
+def fact_keys(kb, rel_ids, subj_ids, obj_ids):
+    '''
+    :return: int64 keys which uniquely identify each (rel, subj, obj) id triple of kb, arguments are broadcast
+    '''
+    return pack_pairs(pack_pairs(rel_ids, subj_ids, kb.dim_size(1)), obj_ids, kb.dim_size(2))
+
+
+def find_sorted(sorted_keys, keys):
+    '''
+    :return: position of each key in sorted_keys, -1 for unknown keys
+    '''
+    keys = np.asarray(keys, dtype=np.int64)
+    if len(sorted_keys) == 0:
+        return np.zeros(keys.shape, dtype=np.int64) - 1
+    pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return np.where(sorted_keys[pos] == keys, pos, -1)
+
+
+class CSRIndex:
+    '''
+    Maps int64 keys to variable length lists of int64 values, stored as compressed sparse rows over sorted keys.
+    Values of the same key keep the order in which they were given.
+    '''
+
+    def __init__(self, keys, values, offsets=None):
+        '''
+        :param offsets: if given, keys are already sorted and unique and values[offsets[i]:offsets[i+1]] belong
+        to keys[i]
+        '''
+        if offsets is not None:
+            self.keys, self.values, self.offsets = keys, values, offsets
+        else:
+            keys = np.asarray(keys, dtype=np.int64)
+            order = np.argsort(keys, kind="mergesort")
+            keys = keys[order]
+            self.values = np.asarray(values, dtype=np.int64)[order]
+            self.keys, starts = np.unique(keys, return_index=True)
+            self.offsets = np.append(starts, len(keys)).astype(np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, key):
+        '''
+        :return: values of a single key, None if it is unknown
+        '''
+        row = self.find([key])[0]
+        if row < 0:
+            return None
+        return self.values[self.offsets[row]:self.offsets[row + 1]]
+
+    def find(self, keys):
+        '''
+        :return: row of each key, -1 for unknown keys
+        '''
+        return find_sorted(self.keys, keys)
+
+    def gather(self, keys):
+        '''
+        :return: batch position, position within its row and value of all values stored for the given keys
+        (ordered by batch position), as well as the number of values of each key
+        '''
+        rows = self.find(keys)
+        if len(self.keys) == 0:
+            empty = np.zeros([0], dtype=np.int64)
+            return empty, empty, empty, np.zeros(rows.shape, dtype=np.int64)
+        known = rows >= 0
+        rows = np.maximum(rows, 0)
+        counts = np.where(known, self.offsets[rows + 1] - self.offsets[rows], 0)
+        batch_pos = np.repeat(np.arange(len(rows)), counts)
+        in_row = np.arange(len(batch_pos)) - np.repeat(np.cumsum(counts) - counts, counts)
+        values = self.values[self.offsets[rows][batch_pos] + in_row]
+        return batch_pos, in_row, values, counts
+
+
+def sparse_features(batch_pos, cols, values, counts, default_value):
+    '''
+    Appends a default feature to every row and orders everything row-major, as needed by SparseTensors.
+    :return: sparse indices, sparse values and max number of columns
+    '''
+    batch_size = len(counts)
+    rows = np.concatenate([batch_pos, np.arange(batch_size)])
+    cols = np.concatenate([cols, counts])
+    values = np.concatenate([values, np.repeat(np.int64(default_value), batch_size)])
+    order = np.argsort(rows, kind="mergesort")
+    sparse_indices = np.column_stack([rows[order], cols[order]]).astype(np.int64)
+    max_cols = int(counts.max()) + 1 if batch_size > 0 else 1
+    return sparse_indices, values[order].astype(np.int64), max_cols
+
+
+def index_cache(kb):
+    '''
+    :return: the KBIndexCache attached to kb, created if there is none yet
+    '''
+    if kb.index_cache is None:
+        kb.index_cache = KBIndexCache(kb)
+    return kb.index_cache
+
+
+class KBIndexCache:
+    '''
+    Indexes derived from the facts of a kb (tuple ids, tuple -> observed relations, relation co-occurrences).
+    Every index is built once per kb and shared by all models using it. If fn is given, indexes are also
+    stored there and reused by later runs on the same kb.
+    '''
+
+    def __init__(self, kb, fn=None):
+        self._kb = kb
+        self._fn = fn
+        self._fact_ids = None
+        self._arrays = dict()
+        # arguments of both positions share one key space, because tuples are also looked up inverted
+        self.num_args = max(kb.dim_size(1), kb.dim_size(2))
+        self._fingerprint = np.array([len(kb.get_all_facts())] +
+                                     [kb.dim_size(dim) for dim in xrange(3)] +
+                                     [zlib.crc32(repr(kb.get_vocab(dim))) for dim in xrange(3) if kb.dim_size(dim) > 0],
+                                     dtype=np.int64)
+        if fn and os.path.exists(fn):
+            stored = np.load(fn)
+            if "fingerprint" in stored.files and np.array_equal(stored["fingerprint"], self._fingerprint):
+                self._arrays = dict((k, stored[k]) for k in stored.files if k != "fingerprint")
+            else:
+                print("Index cache %s does not fit kb, rebuilding it." % fn)
+
+    def _save(self):
+        if self._fn:
+            try:
+                # several processes (e.g., trainer and eval_daemon.py) might write the same cache
+                tmp_fn = "%s.%d.tmp.npz" % (self._fn, os.getpid())
+                np.savez(tmp_fn, fingerprint=self._fingerprint, **self._arrays)
+                os.rename(tmp_fn, self._fn)
+            except (IOError, OSError) as e:
+                print("Could not write index cache %s: %s" % (self._fn, e))
+
+    def _get(self, name, build_f):
+        '''
+        :param build_f: returns a dict of arrays which make up the index
+        :return: dict of arrays of the index
+        '''
+        prefix = name + "__"
+        if not any(k.startswith(prefix) for k in self._arrays):
+            for k, v in build_f().items():
+                self._arrays[prefix + k] = v
+            self._save()
+        return dict((k[len(prefix):], v) for k, v in self._arrays.items() if k.startswith(prefix))
+
+    def fact_ids(self, typs):
+        '''
+        :return: relation, subject and object ids of all triples with type in typs
+        '''
+        if self._fact_ids is None:
+            ids = dict()
+            for keys, _, typ in self._kb.get_all_facts():
+                if len(keys) != 3:
+                    continue
+                (rel, subj, obj) = keys
+                if typ not in ids:
+                    ids[typ] = ([], [], [])
+                rel_ids, subj_ids, obj_ids = ids[typ]
+                rel_ids.append(self._kb.get_id(rel, 0))
+                subj_ids.append(self._kb.get_id(subj, 1))
+                obj_ids.append(self._kb.get_id(obj, 2))
+            self._fact_ids = dict((typ, tuple(np.array(a, dtype=np.int64) for a in arrays))
+                                  for typ, arrays in ids.items())
+        arrays = [self._fact_ids[typ] for typ in sorted(typs) if typ in self._fact_ids]
+        if not arrays:
+            return tuple(np.zeros([0], dtype=np.int64) for _ in xrange(3))
+        return tuple(np.concatenate([a[i] for a in arrays]) for i in xrange(3))
+
+    def tuple_keys(self, which_sets):
+        '''
+        :return: sorted packed keys (see pack_pairs with num_args) of all (subj, obj) tuples of which_sets
+        '''
+        def build():
+            _, subj_ids, obj_ids = self.fact_ids(which_sets)
+            return {"keys": np.unique(pack_pairs(subj_ids, obj_ids, self.num_args))}
+        return self._get("tuple_keys_" + "+".join(sorted(which_sets)), build)["keys"]
+
+    def tuple_rels(self, which_sets):
+        '''
+        Observed relations are numbered by their order in the kb vocab. Tuples are also observed in inverse
+        direction with relation id + number of observed relations.
+        :return: kb ids of observed relations, CSRIndex from packed (subj, obj) keys to observed relation ids
+        '''
+        def build():
+            rel_ids, subj_ids, obj_ids = self.fact_ids(which_sets)
+            observed = np.unique(rel_ids)
+            obs_ids = np.searchsorted(observed, rel_ids)
+            index = CSRIndex(np.concatenate([pack_pairs(subj_ids, obj_ids, self.num_args),
+                                             pack_pairs(obj_ids, subj_ids, self.num_args)]),
+                             np.concatenate([obs_ids, obs_ids + len(observed)]))
+            return {"observed": observed, "keys": index.keys, "offsets": index.offsets, "values": index.values}
+        arrays = self._get("tuple_rels_" + "+".join(sorted(which_sets)), build)
+        return arrays["observed"], CSRIndex(arrays["keys"], arrays["values"], arrays["offsets"])
+
+    def fact_keys(self, typs):
+        '''
+        :return: sorted keys (see fact_keys) of all triples with type in typs
+        '''
+        def build():
+            return {"keys": np.unique(fact_keys(self._kb, *self.fact_ids(typs)))}
+        return self._get("fact_keys_" + "+".join(sorted(typs)), build)["keys"]
+
+    def rel_coocs(self, which_sets):
+        '''
+        Co-occurrences of the relation of every fact with the relations observed for its tuple (see tuple_rels).
+        Relations that are not observed are numbered after the observed ones.
+        :return: relation id of every kb relation, upper bound of relation ids and sorted packed co-occurrence keys
+        '''
+        def build():
+            observed, tuple_rels = self.tuple_rels(which_sets)
+            num_rels = self._kb.dim_size(0)
+            rel_ids = np.zeros([num_rels], dtype=np.int64)
+            is_observed = np.zeros([num_rels], dtype=np.bool)
+            is_observed[observed] = True
+            rel_ids[observed] = np.arange(len(observed))
+            rel_ids[~is_observed] = len(observed) + np.arange(num_rels - len(observed))
+            num_cooc_rels = max(num_rels, 2 * len(observed))
+
+            fact_rels, subj_ids, obj_ids = self.fact_ids(self.fact_types())
+            batch_pos, _, rels, _ = tuple_rels.gather(pack_pairs(subj_ids, obj_ids, self.num_args))
+            rels_of_facts = rel_ids[fact_rels][batch_pos]
+            keys = pack_pairs(rels_of_facts, rels, num_cooc_rels)[rels_of_facts != rels]
+            return {"rel_ids": rel_ids, "num_rels": np.array([num_cooc_rels], dtype=np.int64),
+                    "keys": np.unique(keys)}
+        arrays = self._get("rel_coocs_" + "+".join(sorted(which_sets)), build)
+        return arrays["rel_ids"], int(arrays["num_rels"][0]), arrays["keys"]
+
+    def fact_types(self):
+        self.fact_ids([])
+        return self._fact_ids.keys()
@@ -10,13 +10,18 @@ def default_init():
 
 def create_model(kb, size, batch_size, is_train=True, num_neg=200, learning_rate=1e-2,
                  l2_lambda=0.0, is_batch_training=False, type="DistMult",
-                 observed_sets=["train_text"], composition=None, num_buckets= 10):
+                 observed_sets=["train_text"], composition=None, num_buckets= 10, optimizer="Adam",
+                 num_shared_neg=0):
     '''
     Factory Method for all models
     :param type: any or combination of "ModelF", "DistMult", "ModelE", "ModelO", "ModelN"
     :param composition: "Tanh", "LSTM", "GRU", "BiTanh", "BiLSTM", "BiGRU", "BoW" or None
+    :param optimizer: "Adam", "LazyAdam" or "Adagrad", used if not is_batch_training
+    :param num_shared_neg: if > 0, number of negatives shared within training batches (only DistMult and ModelE)
     :return: Model(s) of type "type"
     '''
+    assert num_shared_neg <= 0 or (type in ["DistMult", "ModelE"] and not composition), \
+        "Shared negatives are only supported by DistMult and ModelE without composition."
     if not isinstance(type, list):
         if not composition:
             composition = ""
@@ -40,41 +45,52 @@ def create_model(kb, size, batch_size, is_train=True, num_neg=200, learning_rate
                 composition = None
 
         if type == "ModelF":
-            return ModelF(kb, size, batch_size, is_train, num_neg, learning_rate, l2_lambda, is_batch_training)
+            return ModelF(kb, size, batch_size, is_train, num_neg, learning_rate, l2_lambda, is_batch_training,
+                          optimizer=optimizer)
         elif type == "DistMult":
             if composition:
-                return CompDistMult(kb, size, batch_size, composition, is_train, num_neg, learning_rate)
+                return CompDistMult(kb, size, batch_size, composition, is_train, num_neg, learning_rate,
+                                    optimizer=optimizer)
             else:
-                return DistMult(kb, size, batch_size, is_train, num_neg, learning_rate, l2_lambda, is_batch_training)
+                return DistMult(kb, size, batch_size, is_train, num_neg, learning_rate, l2_lambda, is_batch_training,
+                                optimizer=optimizer, num_shared_neg=num_shared_neg)
         elif type == "ModelE":
             if composition:
-                return CompModelE(kb, size, batch_size, composition, is_train, num_neg, learning_rate)
+                return CompModelE(kb, size, batch_size, composition, is_train, num_neg, learning_rate,
+                                  optimizer=optimizer)
             else:
-                return ModelE(kb, size, batch_size, is_train, num_neg, learning_rate, l2_lambda, is_batch_training)
+                return ModelE(kb, size, batch_size, is_train, num_neg, learning_rate, l2_lambda, is_batch_training,
+                              optimizer=optimizer, num_shared_neg=num_shared_neg)
         elif type == "ModelO":
             if composition:
-                return CompModelO(kb, size, batch_size, composition, is_train, num_neg, learning_rate, observed_sets)
+                return CompModelO(kb, size, batch_size, composition, is_train, num_neg, learning_rate, observed_sets,
+                                  optimizer=optimizer)
             else:
-                return ModelO(kb, size, batch_size, is_train, num_neg, learning_rate, l2_lambda, is_batch_training, observed_sets)
+                return ModelO(kb, size, batch_size, is_train, num_neg, learning_rate, l2_lambda, is_batch_training,
+                              observed_sets, optimizer=optimizer)
         elif type == "WeightedModelO":
             if composition:
-                return CompWeightedModelO(kb, size, batch_size, composition, is_train, num_neg, learning_rate, observed_sets)
+                return CompWeightedModelO(kb, size, batch_size, composition, is_train, num_neg, learning_rate,
+                                          observed_sets, optimizer=optimizer)
             else:
-                return WeightedModelO(kb, size, batch_size, is_train, num_neg, learning_rate, l2_lambda, is_batch_training, observed_sets)
+                return WeightedModelO(kb, size, batch_size, is_train, num_neg, learning_rate, l2_lambda,
+                                      is_batch_training, observed_sets, optimizer=optimizer)
         elif type == "BlurWeightedModelO":
-            return BlurWeightedModelO(kb, size, batch_size, is_train, num_neg, learning_rate, l2_lambda, is_batch_training, observed_sets)
+            return BlurWeightedModelO(kb, size, batch_size, is_train, num_neg, learning_rate, l2_lambda,
+                                      is_batch_training, observed_sets, optimizer=optimizer)
         elif type == "ModelN":
-            return ModelN(kb, size, batch_size, is_train, num_neg, learning_rate, l2_lambda, is_batch_training)
+            return ModelN(kb, size, batch_size, is_train, num_neg, learning_rate, l2_lambda, is_batch_training,
+                          optimizer=optimizer)
         else:
             raise NameError("There is no model with type %s. "
                             "Possible values are 'ModelF', 'DistMult', 'ModelE', 'ModelO', 'ModelN'." % type)
     else:
         if composition:
             return CompCombinedModel(type, kb, size, batch_size, is_train, num_neg,
-                                     learning_rate, l2_lambda, is_batch_training, composition)
+                                     learning_rate, l2_lambda, is_batch_training, composition, optimizer=optimizer)
         else:
             return CombinedModel(type, kb, size, batch_size, is_train, num_neg,
-                                 learning_rate, l2_lambda, is_batch_training, composition)
+                                 learning_rate, l2_lambda, is_batch_training, composition, optimizer=optimizer)
 
 
 @tf.ops.RegisterGradient("SparseToDense")
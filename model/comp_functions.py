@@ -12,17 +12,27 @@ class CompositionFunction:
         self._batch_size = batch_size
         self._rel2seq = rel2seq
         self.learning_rate = tf.Variable(float(learning_rate), trainable=False, name="lr")
+        # compositions computed with the current parameters, cleared by every update and by reset_cache
+        self._cache = dict()
+        # padded inputs, composed rels and their positions of every batch of the last forward pass, see backward
+        self.last_batches = []
         self.opt = tf.train.AdamOptimizer(learning_rate=self.learning_rate, beta1=0.0)
         l_count = dict()
         total = 0
         max_l = 0
         self._vocab = {"#PADDING#": 0}
+        # word ids of every relation of the kb, see _seq_row
+        self._seq_rows = dict()
+        seqs = []
         for (rel, _, _), _, typ in kb.get_all_facts():
-            s = self._rel2seq(rel)
-            l = len(s)
-            for word in s:
-                if word not in self._vocab:
-                    self._vocab[word] = len(self._vocab)
+            if rel not in self._seq_rows:
+                s = self._rel2seq(rel)
+                for word in s:
+                    if word not in self._vocab:
+                        self._vocab[word] = len(self._vocab)
+                self._seq_rows[rel] = len(seqs)
+                seqs.append([self._vocab[w] for w in s])
+            l = len(seqs[self._seq_rows[rel]])
             max_l = max(max_l, l)
             if l not in l_count:
                 l_count[l] = 0
@@ -49,14 +59,41 @@ class CompositionFunction:
             self._buckets.append(max_l)
             self._bucket_outputs.append(seq_outputs[-1])
 
-        self._input = [[0]*self._batch_size for _ in xrange(max_l)]  # fill input with padding
-        self._feed_dict = dict()
-        train_params = filter(lambda v: "composition" in v.name, tf.trainable_variables())
+        # sequences are padded on the left, so all sequences of a batch end in its last time step
+        self._max_l = max_l
+        self._seq_lengths = np.array([len(seq) for seq in seqs], dtype=np.int32)
+        self._seqs = np.zeros([len(seqs), max_l], dtype=np.int32)
+        for row, seq in enumerate(seqs):
+            self._seqs[row, max_l-len(seq):] = seq
+        self._train_params = filter(lambda v: "composition" in v.name, tf.trainable_variables())
         self._grad = tf.placeholder(tf.float32, shape=[None, self._size], name="rel_grad")
-        self._grad_in = np.zeros((self._batch_size, self._size), dtype=np.float32)
-        self._grads = [tf.gradients(o, train_params, self._grad) for o in self._bucket_outputs]
-        self._bucket_update = [self.opt.apply_gradients(zip(grads, train_params))
-                               for o, grads in zip(self._bucket_outputs, self._grads)]
+        # gradient and update subgraphs are built the first time a bucket is trained, see _bucket_update_op. The
+        # longest bucket depends on all parameters, building it now creates all optimizer variables before they are
+        # initialized and saved.
+        self._bucket_update = dict()
+        self._bucket_update_op(len(self._buckets) - 1)
+
+    def _bucket_update_op(self, bucket_id, sess=None):
+        '''
+        :return: update op of the bucket, which is built and cached on first use
+        :param sess: variables that the optimizer creates for a new bucket are initialized in sess
+        '''
+        if bucket_id not in self._bucket_update:
+            existing = set(tf.all_variables())
+            grads = tf.gradients(self._bucket_outputs[bucket_id], self._train_params, self._grad)
+            self._bucket_update[bucket_id] = self.opt.apply_gradients(zip(grads, self._train_params))
+            new_vars = [v for v in tf.all_variables() if v not in existing]
+            if new_vars and sess is not None:
+                sess.run(tf.initialize_variables(new_vars))
+        return self._bucket_update[bucket_id]
+
+    def build_updates(self, sess):
+        '''
+        Builds the update ops of all buckets, so that the graph does not change while another thread runs the session,
+        see pipeline.PipelinedTrainer.
+        '''
+        for bucket_id in xrange(len(self._buckets)):
+            self._bucket_update_op(bucket_id, sess)
 
     def _comp_f(self):
         pass
@@ -64,94 +101,155 @@ class CompositionFunction:
     def name(self):
         return "BoW"
 
-    def _rel2word_ids(self, rel):
-        return [self._vocab[w] for w in self._rel2seq(rel)]
-
-    def _finish_batch(self, batch_size, batch_length):
-        if batch_size < self._batch_size:
-            for seq_in, inp in zip(self._seq_inputs, self._input):
-                self._feed_dict[seq_in] = inp[:batch_size]
-            self._feed_dict[self._grad] = self._grad_in[:batch_size]
-        else:
-            for seq_in, inp in zip(self._seq_inputs, self._input):
-                self._feed_dict[seq_in] = inp
-            self._feed_dict[self._grad] = self._grad_in
-
-    def _add_input(self, b, j, inp):
-        self._input[j][b] = inp
-
-    def forward(self, sess, rels):
-        self._last_rel_groups = dict()
-        self._last_rels = []
-        for i, rel in enumerate(rels):
-            if rel in self._last_rel_groups:
-                self._last_rel_groups[rel].append(i)
-            else:
-                self._last_rel_groups[rel] = [i]
-                self._last_rels.append((rel, self._rel2word_ids(rel)))
-        self._last_sorted = np.argsort(np.array(map(lambda x: len(x[1]), self._last_rels)))
-
-        compositions = [None] * len(rels)
+    def _seq_row(self, rel):
+        '''
+        :return: row of rel in the padded sequence matrix, relations that are not in the kb are added on first use
+        '''
+        row = self._seq_rows.get(rel)
+        if row is None:
+            seq = [self._vocab[w] for w in self._rel2seq(rel)]
+            padded = np.zeros([1, self._max_l], dtype=np.int32)
+            padded[0, self._max_l-len(seq):] = seq
+            row = len(self._seqs)
+            self._seqs = np.concatenate([self._seqs, padded])
+            self._seq_lengths = np.append(self._seq_lengths, np.int32(len(seq)))
+            self._seq_rows[rel] = row
+        return row
+
+    def _seq_feed_dict(self, inputs, batch_length):
+        '''
+        :param inputs: batch_size x max_l matrix of word ids, of which the first batch_length time steps are used
+        '''
+        return dict(zip(self._seq_inputs, inputs.T))
+
+    def _prepare(self, rels):
+        '''
+        Groups rels by distinct relation and splits the distinct relations, sorted by length, into batches.
+        :return: list of (start, batch_size, bucket_id, batch_length) of all batches
+        '''
+        rows, inverse = np.unique(np.array([self._seq_row(rel) for rel in rels], dtype=np.int64),
+                                  return_inverse=True)
+        order = np.argsort(self._seq_lengths[rows], kind="mergesort")
+        self._last_rows = rows[order]
+        # position of the composition of each rel in the sorted distinct relations
+        positions = np.zeros([len(rows)], dtype=np.int64)
+        positions[order] = np.arange(len(rows))
+        self._last_positions = positions[inverse]
+
+        batches = []
         i = 0
-        while i < len(self._last_rels):
-            batch_size = min(self._batch_size, len(self._last_rels)-i)
-            batch_length = len(self._last_rels[self._last_sorted[i+batch_size-1]][1])
+        while i < len(self._last_rows):
+            batch_size = min(self._batch_size, len(self._last_rows)-i)
+            batch_length = self._seq_lengths[self._last_rows[i+batch_size-1]]
             bucket_id = 0
             for idx, bucket_length in enumerate(self._buckets):
                 if bucket_length >= batch_length:
                     batch_length = bucket_length
                     bucket_id = idx
                     break
-            for b in xrange(batch_size):
-                _, rel_symbols = self._last_rels[self._last_sorted[i+b]]
-                offset = batch_length-len(rel_symbols)
-                for j in xrange(offset):
-                    self._add_input(b, j, 0)  # padding
-                for j, w_id in enumerate(rel_symbols):
-                    self._add_input(b, j+offset, w_id)
-
-            self._finish_batch(batch_size, batch_length)
-            out = sess.run(self._bucket_outputs[bucket_id], feed_dict=self._feed_dict)
-            for b in xrange(batch_size):
-                rel_idx = self._last_sorted[i+b]
-                rel, _ = self._last_rels[rel_idx]
-                for j in self._last_rel_groups[rel]:
-                    compositions[j] = out[b]
-
+            batches.append((i, batch_size, bucket_id, batch_length))
             i += batch_size
+        return batches
+
+    def _batch_feed_dict(self, i, batch_size, batch_length):
+        '''
+        :return: new feed dict with the padded sequences of the batch, which backward reuses
+        '''
+        inputs = np.zeros([batch_size, self._max_l], dtype=np.int32)
+        inputs[:, :batch_length] = self._seqs[self._last_rows[i:i+batch_size], self._max_l-batch_length:]
+        return self._seq_feed_dict(inputs, batch_length)
+
+    def _batch_members(self, i, batch_size):
+        '''
+        :return: indices of the rels whose compositions are in the batch and their position within the batch
+        '''
+        members = np.where((self._last_positions >= i) & (self._last_positions < i + batch_size))[0]
+        return members, self._last_positions[members] - i
+
+    def _batch_grads(self, grads, batch_size, members, positions):
+        '''
+        :param grads: array with the gradient of the composition of each rel
+        :param members, positions: see _batch_members
+        '''
+        batch_grads = np.zeros((batch_size, self._size), dtype=np.float32)
+        np.add.at(batch_grads, positions, grads[members])
+        return batch_grads
+
+    def forward(self, sess, rels, cached=False):
+        '''
+        :param cached: reuse compositions computed with the current parameters, which are cached until the next
+        update or reset_cache. Not for training, backward only updates compositions that were actually computed.
+        :return: array with the composition of each rel
+        '''
+        if not cached:
+            return self._compose(sess, rels)
+        missing = list(set(rel for rel in rels if rel not in self._cache))
+        if missing:
+            self._cache.update(zip(missing, self._compose(sess, missing)))
+        return np.array([self._cache[rel] for rel in rels], dtype=np.float32).reshape([-1, self._size])
+
+    def reset_cache(self):
+        '''
+        Has to be called after parameters were changed other than by backward or fused_step, e.g., restored.
+        '''
+        self._cache = dict()
+
+    def _compose(self, sess, rels):
+        compositions = np.zeros([len(rels), self._size], dtype=np.float32)
+        batches = []
+        for i, batch_size, bucket_id, batch_length in self._prepare(rels):
+            feed_dict = self._batch_feed_dict(i, batch_size, batch_length)
+            members, positions = self._batch_members(i, batch_size)
+            batches.append((batch_size, bucket_id, feed_dict, members, positions))
+            out = sess.run(self._bucket_outputs[bucket_id], feed_dict=feed_dict)
+            compositions[members] = out[positions]
+        self.last_batches = batches
         return compositions
 
-    #TODO: optimization
-    def backward(self, sess, grads):
-        # ineffective because forward pass is run here again
-        i = 0
-        while i < len(self._last_rels):
-            batch_size = min(len(self._last_rels)-i, self._batch_size)
-            batch_length = len(self._last_rels[self._last_sorted[i+batch_size-1]][1])
-            bucket_id = 0
-            for idx, bucket_length in enumerate(self._buckets):
-                if bucket_length >= batch_length:
-                    batch_length = bucket_length
-                    bucket_id = idx
-                    break
-
-            self._grad_in *= 0.0  # zero grads
-
-            for b in xrange(batch_size):
-                rel, rel_symbols = self._last_rels[self._last_sorted[i+b]]
-                offset = batch_length-len(rel_symbols)
-                for j in xrange(offset):
-                    self._add_input(b, j, 0)  # padding
-                for j, w_id in enumerate(rel_symbols):
-                    self._add_input(b, j+offset, w_id)
-
-                for j in self._last_rel_groups[rel]:
-                    self._grad_in[b] += grads[j]
+    def backward(self, sess, grads, batches=None):
+        '''
+        Updates the composition with the gradients of the compositions of a forward pass. The padded
+        inputs of forward are reused, but the update recomputes the forward pass; see fused_step, which does not.
+        :param batches: last_batches after the forward pass that grads belong to, defaults to the last forward pass
+        '''
+        self.reset_cache()
+        grads = np.asarray(grads, dtype=np.float32)
+        if batches is None:
+            batches = self.last_batches
+        for batch_size, bucket_id, feed_dict, members, positions in batches:
+            feed_dict[self._grad] = self._batch_grads(grads, batch_size, members, positions)
+            sess.run(self._bucket_update_op(bucket_id, sess), feed_dict=feed_dict)
+
+    def fused_step(self, sess, rels, fetches, feed_dict, forward_f, backward_f):
+        '''
+        Composes rels, runs fetches of the scoring graph and updates the composition in a single partial run, so the
+        backward pass of the composition reuses the activations of its forward pass. Only possible if the distinct
+        rels fit into a single batch and the session supports partial runs.
+        :param forward_f: function that feeds compositions (array, one row per rel) to the scoring graph
+        :param backward_f: function from the results of fetches to gradients of the compositions
+        :return: results of fetches, or None if the step is not possible
+        '''
+        if not hasattr(sess, "partial_run_setup"):
+            return None
+        batches = self._prepare(rels)
+        if len(batches) != 1:
+            return None
+        self.reset_cache()
+        i, batch_size, bucket_id, batch_length = batches[0]
+        comp_feed_dict = self._batch_feed_dict(i, batch_size, batch_length)
+        output = self._bucket_outputs[bucket_id]
+        update = self._bucket_update_op(bucket_id, sess)
+        handle = sess.partial_run_setup([output, update] + fetches,
+                                        comp_feed_dict.keys() + feed_dict.keys() + [self._grad])
+        members, positions = self._batch_members(i, batch_size)
+        compositions = np.zeros([len(rels), self._size], dtype=np.float32)
+        compositions[members] = sess.partial_run(handle, output, comp_feed_dict)[positions]
+        forward_f(compositions)
+        results = sess.partial_run(handle, fetches, feed_dict)
+        grads = np.asarray(backward_f(results), dtype=np.float32)
+        sess.partial_run(handle, update, {self._grad: self._batch_grads(grads, batch_size, members, positions)})
+        return results
 
-            self._finish_batch(batch_size, batch_length)
-
-            sess.run(self._bucket_update[bucket_id], feed_dict=self._feed_dict)
-            i += batch_size
 
 class BoWCompF(CompositionFunction):
     def _comp_f(self):
@@ -212,22 +310,14 @@ class BiRNNCompF(CompositionFunction):
         assert cell.output_size == size/2, "cell size must be size / 2 for BiRNNs"
         self._cell = cell
         CompositionFunction.__init__(self, kb, size, num_buckets, rel2seq, batch_size, learning_rate)
-        self._rev_input = [[0]*self._batch_size for _ in xrange(len(self._input))]
-
-    def _finish_batch(self, batch_size, batch_length):
-        self._rev_input[:batch_length] = self._input[(batch_length-1)::-1]
-        if batch_size < self._batch_size:
-            for seq_in, inp in zip(self._seq_inputs, self._input):
-                self._feed_dict[seq_in] = inp[:batch_size]
-            for seq_in, inp in zip(self._rev_seq_inputs, self._rev_input):
-                self._feed_dict[seq_in] = inp[:batch_size]
-            self._feed_dict[self._grad] = self._grad_in[:batch_size]
-        else:
-            for seq_in, inp in zip(self._seq_inputs, self._input):
-                self._feed_dict[seq_in] = inp
-            for seq_in, inp in zip(self._rev_seq_inputs, self._rev_input):
-                self._feed_dict[seq_in] = inp
-            self._feed_dict[self._grad] = self._grad_in
+
+    def _seq_feed_dict(self, inputs, batch_length):
+        feed_dict = CompositionFunction._seq_feed_dict(self, inputs, batch_length)
+        # reversed sequences start at the end of the batch, later time steps are padding
+        rev_inputs = np.zeros_like(inputs)
+        rev_inputs[:, :batch_length] = inputs[:, batch_length-1-np.arange(batch_length)]
+        feed_dict.update(zip(self._rev_seq_inputs, rev_inputs.T))
+        return feed_dict
 
     def _comp_f(self):
         self._rev_seq_inputs = [tf.placeholder(tf.int64, shape=[None], name="seq_input%d" % i)
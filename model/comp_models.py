@@ -1,13 +1,16 @@
 from model.models import *
 import tensorflow as tf
 import model
+import kb_index
 from tensorflow.models.rnn.rnn_cell import *
 
 
 class CompositionalKBScoringModel(AbstractKBScoringModel):
-    def __init__(self, kb, size, batch_size, comp_model, is_train=True, num_neg=200, learning_rate=1e-2):
+    def __init__(self, kb, size, batch_size, comp_model, is_train=True, num_neg=200, learning_rate=1e-2,
+                 optimizer="Adam"):
         self._comp_model = comp_model
-        AbstractKBScoringModel.__init__(self, kb, size, batch_size, is_train, num_neg, learning_rate, 0.0, False)
+        AbstractKBScoringModel.__init__(self, kb, size, batch_size, is_train, num_neg, learning_rate, 0.0, False,
+                                        optimizer)
 
     def _input_params(self):
         return [self._rel_input]
@@ -40,20 +43,49 @@ class CompositionalKBScoringModel(AbstractKBScoringModel):
             self._feed_dict[self._obj_input] = self._obj_in
             self._feed_dict[self._rel_input] = self._rel_in
 
+    def _ids_feed_dict(self, rel_ids, subj_ids, obj_ids):
+        rel_vocab = self._kb.get_vocab(0)
+        self._rels = [rel_vocab[r_i] for r_i in rel_ids]
+        return {self._subj_input: subj_ids, self._obj_input: obj_ids, self._rel_input: self._rel_in[:len(rel_ids)]}
+
     def name(self):
         return self.__class__.__name__ + "__" + self._comp_model.name()
 
     def _get_feed_dict(self):
         return self._feed_dict
 
-    def _composition_forward(self, sess):
-        rel_embeddings = self._comp_model.forward(sess, self._rels)
-        for b in xrange(len(rel_embeddings)):
-            self._rel_in[b] = rel_embeddings[b]
+    def _composition_forward(self, sess, cached=False):
+        self._set_compositions(self._comp_model.forward(sess, self._rels, cached))
+        # kept with the inputs they belong to, see pipeline.PipelinedTrainer
+        self._comp_batches = self._comp_model.last_batches
+
+    def precompute_compositions(self, sess):
+        '''
+        Composes all relations of the kb once, so scoring with the current parameters only looks them up.
+        '''
+        self._comp_model.forward(sess, list(self._kb.get_symbols(0)), cached=True)
+
+    def reset_composition_cache(self):
+        '''
+        Drops cached compositions, has to be called after restoring a checkpoint.
+        '''
+        self._comp_model.reset_cache()
+
+    def _set_compositions(self, rel_embeddings):
+        '''
+        Feeds the compositions of self._rels (array, one row per rel) to the scoring graph.
+        '''
+        self._rel_in[:len(rel_embeddings)] = rel_embeddings
 
     def _composition_backward(self, sess, grads):
-        grad_list = [grads[0][b] for b in xrange(grads[0].shape[0])]
-        self._comp_model.backward(sess, grad_list)
+        self._comp_model.backward(sess, self._composition_grads(grads), self._comp_batches)
+
+    def _composition_grads(self, grads):
+        '''
+        :param grads: gradients of the input params, see _input_params
+        :return: array with the gradient of the composition of each of self._rels
+        '''
+        return grads[0]
 
     def score_triples(self, sess, triples):
         i = 0
@@ -64,8 +96,23 @@ class CompositionalKBScoringModel(AbstractKBScoringModel):
             for j in xrange(batch_size):
                 self._add_triple_to_input(triples[i+j], j)
             self._finish_adding_triples(batch_size)
-            self._composition_forward(sess)
-            result[i:i+batch_size] = sess.run(self._scores, feed_dict=self._get_feed_dict())
+            self._composition_forward(sess, cached=True)
+            result[i:i+batch_size] = sess.run(self._scores, feed_dict=self._dedup_feed_dict(self._get_feed_dict()))
+            i += batch_size
+        return result
+
+    def score_ids(self, sess, rel_ids, subj_ids, obj_ids):
+        rel_ids = np.asarray(rel_ids, dtype=np.int64)
+        subj_ids = np.asarray(subj_ids, dtype=np.int64)
+        obj_ids = np.asarray(obj_ids, dtype=np.int64)
+        i = 0
+        result = np.zeros([len(rel_ids)])
+        while i < len(rel_ids):
+            batch_size = min(self._batch_size, len(rel_ids)-i)
+            feed_dict = self._ids_feed_dict(rel_ids[i:i+batch_size], subj_ids[i:i+batch_size],
+                                            obj_ids[i:i+batch_size])
+            self._composition_forward(sess, cached=True)
+            result[i:i+batch_size] = sess.run(self._scores, feed_dict=self._dedup_feed_dict(feed_dict))
             i += batch_size
         return result
 
@@ -79,7 +126,14 @@ class CompositionalKBScoringModel(AbstractKBScoringModel):
         '''
         assert self._is_train, "model has to be created in training mode!"
 
-        assert len(pos_triples) + reduce(lambda acc, x: acc+len(x), neg_triples, 0) == self._batch_size, \
+        return self._run_step(sess, self._add_batch(pos_triples, neg_triples), mode)
+
+    def _add_batch(self, pos_triples, neg_triples):
+        '''
+        Fills the inputs with the positive triples, each followed by its negatives.
+        :return: feed dict of the inputs
+        '''
+        assert len(pos_triples) + sum(len(negs) for negs in neg_triples) == self._batch_size, \
             "batch_size and provided batch do not fit"
 
         j = 0
@@ -92,19 +146,45 @@ class CompositionalKBScoringModel(AbstractKBScoringModel):
                 j += 1
 
         self._finish_adding_triples(j)
+        return self._get_feed_dict()
+
+    def _run_step(self, sess, feed_dict, mode):
+        feed_dict = self._dedup_feed_dict(feed_dict)
+        if mode != "loss" and hasattr(self, "_comp_model"):
+            assert self._is_train, "training only possible in training state."
+            results = self._fused_step(sess, feed_dict)
+            if results is not None:
+                return results[0]
         self._composition_forward(sess)
 
         if mode == "loss":
-            return sess.run(self._loss, feed_dict=self._get_feed_dict())
+            return sess.run(self._loss, feed_dict=feed_dict)
         else:
             assert self._is_train, "training only possible in training state."
-            if hasattr(self, "_update"):
-                res = sess.run([self._loss, self._update] + self._input_grads, feed_dict=self._get_feed_dict())
-                self._composition_backward(sess, res[2:])
-            else:
-                res = sess.run([self._loss] + self._input_grads, feed_dict=self._get_feed_dict())
-                self._composition_backward(sess, res[1:])
-            return res[0]
+            return self._update_step(sess, feed_dict)
+
+    def _update_step(self, sess, feed_dict):
+        '''
+        Updates scoring model and composition, compositions have to be fed already (see _composition_forward).
+        :return: loss
+        '''
+        if hasattr(self, "_update"):
+            res = sess.run([self._loss, self._update] + self._input_grads, feed_dict=feed_dict)
+            self._composition_backward(sess, res[2:])
+        else:
+            res = sess.run([self._loss] + self._input_grads, feed_dict=feed_dict)
+            self._composition_backward(sess, res[1:])
+        return res[0]
+
+    def _fused_step(self, sess, feed_dict):
+        '''
+        Runs composition, scoring and both updates in one partial run, see CompositionFunction.fused_step.
+        :return: results of loss, (update) and input gradients, or None if the step was not possible
+        '''
+        fetches = [self._loss] + ([self._update] if hasattr(self, "_update") else []) + self._input_grads
+        num_grads = len(self._input_grads)
+        return self._comp_model.fused_step(sess, self._rels, fetches, feed_dict, self._set_compositions,
+                                           lambda results: self._composition_grads(results[-num_grads:]))
 
 
 class CompDistMult(CompositionalKBScoringModel):
@@ -113,8 +193,8 @@ class CompDistMult(CompositionalKBScoringModel):
             E_subjs = tf.get_variable("E_s", [len(self._kb.get_symbols(1)), self._size])
             E_objs = tf.get_variable("E_o", [len(self._kb.get_symbols(2)), self._size])
 
-        self.e_subj = tf.tanh(tf.nn.embedding_lookup(E_subjs, self._subj_input))
-        self.e_obj = tf.tanh(tf.nn.embedding_lookup(E_objs, self._obj_input))
+        self.e_subj = self._lookup(E_subjs, self._subj_input, tf.tanh)
+        self.e_obj = self._lookup(E_objs, self._obj_input, tf.tanh)
         self.e_rel = self._rel_input  # relation is already embedded by composition function
         s_o_prod = self.e_obj * self.e_subj
 
@@ -140,8 +220,8 @@ class CompModelE(CompositionalKBScoringModel):
 
         self.e_rel_s, self.e_rel_o = tf.split(1, 2, self._rel_input)
 
-        self.e_subj = tf.tanh(tf.nn.embedding_lookup(E_subjs, self._subj_input))
-        self.e_obj = tf.tanh(tf.nn.embedding_lookup(E_objs, self._obj_input))
+        self.e_subj = self._lookup(E_subjs, self._subj_input, tf.tanh)
+        self.e_obj = self._lookup(E_objs, self._obj_input, tf.tanh)
 
         score = tf_util.batch_dot(self.e_rel_s, self.e_subj) + tf_util.batch_dot(self.e_rel_o, self.e_obj)
 
@@ -151,30 +231,27 @@ class CompModelE(CompositionalKBScoringModel):
 class CompModelO(CompositionalKBScoringModel):
 
     def __init__(self, kb, size, batch_size, comp_model, is_train=True, num_neg=200, learning_rate=1e-2,
-                 which_sets=["train_text"]):
+                 which_sets=["train_text"], optimizer="Adam"):
         self._which_sets = set(which_sets)
         CompositionalKBScoringModel.__init__(self, kb, size, batch_size, comp_model, is_train=True, num_neg=200,
-                                             learning_rate=1e-2)
+                                             learning_rate=1e-2, optimizer=optimizer)
+
+    def _init_tuple_rels(self):
+        # create tuple to rel lookup, which also contains inverse relations of tuples
+        cache = kb_index.index_cache(self._kb)
+        observed, self._tuple_rels = cache.tuple_rels(self._which_sets)
+        self._num_args = cache.num_args
+        rel_names = [self._kb.get_key(r_i, 0) for r_i in observed]
+        self._tuple_rel_names = rel_names + [rel + "_inv" for rel in rel_names]
+
+    def _observed_rels(self, s_i, o_i):
+        rels = self._tuple_rels.get(s_i * self._num_args + o_i)
+        if rels is None:
+            return None
+        return [self._tuple_rel_names[r_i] for r_i in rels]
 
     def _init_inputs(self):
-        self._rel_ids = dict()
-        len(self._kb.get_symbols(0))
-        # create tuple to rel lookup
-        self._tuple_rels_lookup = dict()
-        for (rel, subj, obj), _, typ in self._kb.get_all_facts():
-            if typ in self._which_sets:
-                s_i = self._kb.get_id(subj, 1)
-                o_i = self._kb.get_id(obj, 2)
-                t = (s_i, o_i)
-                if t not in self._tuple_rels_lookup:
-                    self._tuple_rels_lookup[t] = [rel]
-                else:
-                    self._tuple_rels_lookup[t].append(rel)
-                t = (o_i, s_i)
-                if t not in self._tuple_rels_lookup:
-                    self._tuple_rels_lookup[t] = [rel+"_inv"]
-                else:
-                    self._tuple_rels_lookup[t].append(rel+"_inv")
+        self._init_tuple_rels()
 
         self._rel_input = tf.placeholder(tf.float32, shape=[None, self._size], name="rel")
         self._rel_in = np.zeros([self._batch_size, self._size], dtype=np.float32)
@@ -187,12 +264,13 @@ class CompModelO(CompositionalKBScoringModel):
         self.__offsets = []
 
     def _add_triple_to_input(self, t, j):
-        self.__offsets.append(len(self._rels))
         (rel, subj, obj) = t
+        self._add_rel_tuple_to_input(rel, self._kb.get_id(subj, 1), self._kb.get_id(obj, 2), j)
+
+    def _add_rel_tuple_to_input(self, rel, s_i, o_i, j):
+        self.__offsets.append(len(self._rels))
         self._rels.append(rel)
-        s_i = self._kb.get_id(subj, 1)
-        o_i = self._kb.get_id(obj, 2)
-        rels = self._tuple_rels_lookup.get((s_i, o_i))
+        rels = self._observed_rels(s_i, o_i)
         if rels:
             for i in xrange(len(rels)):
                 if rels[i] != rel:
@@ -206,56 +284,57 @@ class CompModelO(CompositionalKBScoringModel):
             self._feed_dict[self._rel_input] = self._rel_in
             self._feed_dict[self._observed_input] = self._observed_in
 
+    def _ids_feed_dict(self, rel_ids, subj_ids, obj_ids):
+        rel_vocab = self._kb.get_vocab(0)
+        self._start_adding_triples()
+        for j in xrange(len(rel_ids)):
+            self._add_rel_tuple_to_input(rel_vocab[rel_ids[j]], subj_ids[j], obj_ids[j], j)
+        self._finish_adding_triples(len(rel_ids))
+        return self._feed_dict
+
     def _scoring_f(self):
         return tf_util.batch_dot(self._rel_input, self._observed_input)
 
     def _input_params(self):
         return [self._rel_input, self._observed_input]
 
-    def _composition_forward(self, sess):
-        rel_embeddings = self._comp_model.forward(sess, self._rels)
-        for b, off in enumerate(self.__offsets):
-            self._rel_in[b] = rel_embeddings[off]
-            end = self.__offsets[b+1] if len(self.__offsets) > (b+1) else len(self._rels)
-            self._observed_in[b] *= 0.0
-            for i in xrange(off+1, end):
-                self._observed_in[b] += rel_embeddings[i]
-            if (end-off-1) > 0:
-                self._observed_in[b] /= (end-off-1)
+    def _segments(self):
+        '''
+        :return: position of the scored relation of each triple in self._rels, mask of the observed relations in
+        self._rels and number of observed relations of each triple
+        '''
+        offsets = np.array(self.__offsets, dtype=np.int64)
+        counts = np.diff(np.append(offsets, len(self._rels))) - 1
+        observed = np.ones([len(self._rels)], dtype=np.bool)
+        observed[offsets] = False
+        return offsets, observed, counts
+
+    def _set_compositions(self, rel_embeddings):
+        offsets, observed, counts = self._segments()
+        batch_size = len(offsets)
+        self._rel_in[:batch_size] = rel_embeddings[offsets]
+        # mean of the observed relations of each triple, zero if there are none
+        observed_in = self._observed_in[:batch_size]
+        observed_in[:] = 0.0
+        non_empty = counts > 0
+        if np.any(non_empty):
+            starts = (np.cumsum(counts) - counts)[non_empty]
+            observed_in[non_empty] = np.add.reduceat(rel_embeddings[observed], starts, axis=0)
+            observed_in[non_empty] /= counts[non_empty, np.newaxis]
+
+    def _composition_grads(self, grads):
+        offsets, observed, counts = self._segments()
+        batch_size = len(offsets)
+        comp_grads = np.zeros([len(self._rels), self._size], dtype=np.float32)
+        comp_grads[offsets] = grads[0][:batch_size]
+        comp_grads[observed] = np.repeat(grads[1][:batch_size] / np.maximum(counts, 1)[:, np.newaxis], counts, axis=0)
+        return comp_grads
 
-    def _composition_backward(self, sess, grads):
-        grad_list = []
-        for b, off in enumerate(self.__offsets):
-            grad_list.append(grads[0][b])
-            end = self.__offsets[b+1] if len(self.__offsets) > (b+1) else len(self._rels)
-            observed_grad = grads[1][b]
-            if (end-off-1) > 0:
-                observed_grad /= (end-off-1)
-            for i in xrange(off+1, end):
-                grad_list.append(observed_grad)
-        self._comp_model.backward(sess, grad_list)
 
 class CompWeightedModelO(CompModelO):
 
     def _init_inputs(self):
-        self._rel_ids = dict()
-        len(self._kb.get_symbols(0))
-        # create tuple to rel lookup
-        self._tuple_rels_lookup = dict()
-        for (rel, subj, obj), _, typ in self._kb.get_all_facts():
-            if typ in self._which_sets:
-                s_i = self._kb.get_id(subj, 1)
-                o_i = self._kb.get_id(obj, 2)
-                t = (s_i, o_i)
-                if t not in self._tuple_rels_lookup:
-                    self._tuple_rels_lookup[t] = [rel]
-                else:
-                    self._tuple_rels_lookup[t].append(rel)
-                t = (o_i, s_i)
-                if t not in self._tuple_rels_lookup:
-                    self._tuple_rels_lookup[t] = [rel+"_inv"]
-                else:
-                    self._tuple_rels_lookup[t].append(rel+"_inv")
+        self._init_tuple_rels()
 
         self._rel_input = tf.placeholder(tf.float32, shape=[None, self._size], name="rel")
         self._sparse_indices_input = tf.placeholder(tf.int64, name="sparse_indices")
@@ -265,19 +344,17 @@ class CompWeightedModelO(CompModelO):
 
     def _start_adding_triples(self):
         self._sparse_indices = []
-        self._rel_in = []
         self._rels = []
-        self._obs_in = []
         self.__offsets = []
         self._max_cols = 1
 
     def _add_triple_to_input(self, t, b):
-        self.__offsets.append(len(self._rels))
         (rel, subj, obj) = t
-        s_i = self._kb.get_id(subj, 1)
-        o_i = self._kb.get_id(obj, 2)
+        self._add_rel_tuple_to_input(rel, self._kb.get_id(subj, 1), self._kb.get_id(obj, 2), b)
 
-        rels = self._tuple_rels_lookup.get((s_i, o_i))
+    def _add_rel_tuple_to_input(self, rel, s_i, o_i, b):
+        self.__offsets.append(len(self._rels))
+        rels = self._observed_rels(s_i, o_i)
         if rels and any(rel_i != rel for rel_i in rels):
             self._rels.append(rel)
             for i in xrange(len(rels)):
@@ -289,6 +366,10 @@ class CompWeightedModelO(CompModelO):
             self._sparse_indices.append([b, 0])
 
     def _finish_adding_triples(self, batch_size):
+        # one row per observed relation of each triple, or a zero row for triples without observed relations;
+        # filled by _set_compositions
+        self._rel_in = np.zeros([len(self._sparse_indices), self._size], dtype=np.float32)
+        self._obs_in = np.zeros([len(self._sparse_indices), self._size], dtype=np.float32)
         self._feed_dict[self._sparse_indices_input] = self._sparse_indices
         self._feed_dict[self._shape_input] = [batch_size, self._max_cols]
         self._feed_dict[self._observed_input] = self._obs_in
@@ -304,43 +385,42 @@ class CompWeightedModelO(CompModelO):
 
         return weighted_scores
 
-    def _composition_forward(self, sess):
-        rel_embeddings = self._comp_model.forward(sess, self._rels)
-        zero_v = np.zeros([self._size], dtype=np.float32)
-        for b, off in enumerate(self.__offsets):
-            end = self.__offsets[b+1] if len(self.__offsets) > (b+1) else len(self._rels)
-            if end == off:
-                self._rel_in.append(zero_v)  # default relation if none was observed
-                self._obs_in.append(zero_v)
-            else:
-                for i in xrange(end - (off+1)):
-                    self._rel_in.append(rel_embeddings[off])
-                self._obs_in.extend(rel_embeddings[off+1:end])
-
-    def _composition_backward(self, sess, grads):
-        grad_list = []
-        skip = 0
-        for b, off in enumerate(self.__offsets):
-            end = self.__offsets[b+1] if len(self.__offsets) > (b+1) else len(self._rels)
-            if end > off:
-                off = off - b + skip
-                end = end - b + skip
-                rel_grad = grads[0][off]
-                for i in xrange(off+1, end):
-                    rel_grad += grads[0][i]
-                grad_list.append(rel_grad)
-
-                observed_grads = grads[1][off:end]
-                grad_list.extend(observed_grads)
-            else:
-                skip += 1
-        self._comp_model.backward(sess, grad_list)
+    def _rows(self):
+        '''
+        :return: for every row of the inputs the triple it belongs to, mask of rows of triples with observed relations,
+        position of the scored relation of each triple in self._rels (only valid for triples with observed relations),
+        mask of the observed relations in self._rels and mask of triples with observed relations
+        '''
+        offsets = np.array(self.__offsets, dtype=np.int64)
+        sizes = np.diff(np.append(offsets, len(self._rels)))
+        non_empty = sizes > 0
+        triples = np.repeat(np.arange(len(offsets)), np.where(non_empty, sizes - 1, 1))
+        observed = np.ones([len(self._rels)], dtype=np.bool)
+        observed[offsets[non_empty]] = False
+        return triples, non_empty[triples], offsets, observed, non_empty
+
+    def _set_compositions(self, rel_embeddings):
+        triples, rows, offsets, observed, _ = self._rows()
+        # rows of triples without observed relations stay zero (default relation)
+        self._rel_in[rows] = rel_embeddings[offsets[triples[rows]]]
+        self._obs_in[rows] = rel_embeddings[observed]
+
+    def _composition_grads(self, grads):
+        triples, rows, offsets, observed, non_empty = self._rows()
+        comp_grads = np.zeros([len(self._rels), self._size], dtype=np.float32)
+        if np.any(rows):
+            # the scored relation of a triple is used in all of its rows
+            row_triples = triples[rows]
+            starts = np.where(np.diff(np.append(-1, row_triples)) != 0)[0]
+            comp_grads[offsets[non_empty]] = np.add.reduceat(grads[0][rows], starts, axis=0)
+            comp_grads[observed] = grads[1][rows]
+        return comp_grads
 
 
 class CompCombinedModel(CompositionalKBScoringModel):
 
     def __init__(self, models, kb, size, batch_size, is_train=True, num_neg=200, learning_rate=1e-2, l2_lambda=0.0,
-                 is_batch_training=False, composition=None, share_vars=False):
+                 is_batch_training=False, composition=None, share_vars=False, optimizer="Adam"):
         self._models = []
         self.__name = '_'.join(models)
         if composition:
@@ -351,7 +431,7 @@ class CompCombinedModel(CompositionalKBScoringModel):
                                                        l2_lambda, False, composition=composition, type=m))
 
         AbstractKBScoringModel.__init__(self, kb, size, batch_size, is_train, num_neg, learning_rate,
-                                        l2_lambda, is_batch_training)
+                                        l2_lambda, is_batch_training, optimizer)
 
     def name(self):
         return self.__name
@@ -379,15 +459,37 @@ class CompCombinedModel(CompositionalKBScoringModel):
         for m in self._models:
             m._start_adding_triples()
 
+    def _ids_feed_dict(self, rel_ids, subj_ids, obj_ids):
+        feed_dict = dict()
+        self._rels = []
+        for m in self._models:
+            feed_dict.update(m._ids_feed_dict(rel_ids, subj_ids, obj_ids))
+            if m._rels:
+                self._rels.extend(m._rels)
+        return feed_dict
+
+    def _dedup_feed_dict(self, feed_dict):
+        for m in self._models:
+            m._dedup_feed_dict(feed_dict)
+        return feed_dict
+
     def _input_params(self):
         ips = []
         for m in self._models:
             ips.extend(m._input_params())
         return ips
 
-    def _composition_forward(self, sess):
+    def _composition_forward(self, sess, cached=False):
+        for m in self._models:
+            m._composition_forward(sess, cached)
+
+    def precompute_compositions(self, sess):
+        for m in self._models:
+            m.precompute_compositions(sess)
+
+    def reset_composition_cache(self):
         for m in self._models:
-            m._composition_forward(sess)
+            m.reset_composition_cache()
 
     def _composition_backward(self, sess, grads):
         i = 0
@@ -2,23 +2,52 @@
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
+from multiprocessing.dummy import Pool
+import os
+import threading
 import numpy as np
 import tensorflow as tf
 from tensorflow.python.ops.seq2seq import *
 import tf_util
 import rprop
+import sparse_opt
+import kb_index
 import model
 
+# thread pool shared by all CombinedModels, see _shared_pool
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _shared_pool():
+    '''
+    :return: thread pool, created on first use and again in forked processes, which do not inherit its threads
+    '''
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = Pool()
+            _pool_pid = os.getpid()
+        return _pool
+
 
 class AbstractKBScoringModel:
 
     def __init__(self, kb, size, batch_size, is_train=True, num_neg=200, learning_rate=1e-2, l2_lambda=0.0,
-                 is_batch_training=False):
+                 is_batch_training=False, optimizer="Adam", num_shared_neg=0):
+        '''
+        :param num_shared_neg: if > 0, train with this many negative subjects and objects shared by all positive
+        triples of a batch (see step_shared) instead of separate negatives for every positive triple
+        '''
         self._kb = kb
         self._size = size
         self._batch_size = batch_size
         self._is_batch_training = is_batch_training
         self._is_train = is_train
+        self._num_shared_neg = num_shared_neg
+        # id inputs that are fed as unique ids and inverse index, see _lookup
+        self._dedup_inputs = dict()
         self._init = model.default_init()
         with vs.variable_scope(self.name(), initializer=self._init):
             self.learning_rate = tf.Variable(float(learning_rate), trainable=False, name="lr")
@@ -27,12 +56,27 @@ class AbstractKBScoringModel:
                 if is_batch_training:
                     self.opt = rprop.RPropOptimizer()  # tf.train.GradientDescentOptimizer(self.learning_rate)
                 else:
-                    self.opt = tf.train.AdamOptimizer(self.learning_rate, beta1=0.0)
+                    self.opt = sparse_opt.create_optimizer(optimizer, self.learning_rate)
             self._init_inputs()
             with vs.variable_scope("score", initializer=self._init):
+                self._score_scope = tf.get_variable_scope()
                 self._scores = self._scoring_f()
-
-        if is_train or is_batch_training:
+                if is_train and num_shared_neg > 0:
+                    assert not is_batch_training, "Shared negatives are not supported for batch training."
+                    tf.get_variable_scope().reuse_variables()
+                    self._init_shared_neg_inputs()
+                    neg_subj_scores, neg_obj_scores = self._shared_neg_scores_f()
+
+        if (is_train or is_batch_training) and num_shared_neg > 0:
+            # every positive is scored against all shared negatives of its subject and object position
+            pos_scores = tf.expand_dims(self._scores, 1)
+            labels = tf.zeros_like(self._rel_input)
+            loss = math_ops.reduce_sum(tf.nn.sparse_softmax_cross_entropy_with_logits(
+                tf.concat(1, [pos_scores, neg_subj_scores + self._neg_subj_mask_input]), labels))
+            loss += math_ops.reduce_sum(tf.nn.sparse_softmax_cross_entropy_with_logits(
+                tf.concat(1, [pos_scores, neg_obj_scores + self._neg_obj_mask_input]), labels))
+            num_pos = 2 * tf.size(self._scores)
+        elif is_train or is_batch_training:
             assert batch_size % (num_neg+1) == 0, "Batch size must be multiple of num_neg+1 during training"
             #with vs.variable_scope("score", initializer=init):
             #    tf.get_variable_scope().reuse_variables()
@@ -50,10 +94,12 @@ class AbstractKBScoringModel:
             labels = tf.constant(labels, name="labels_constant", dtype=tf.float32)
             loss = math_ops.reduce_sum(tf.nn.softmax_cross_entropy_with_logits(scores, labels))
 
+        if is_train or is_batch_training:
             train_params = filter(lambda v: self.name() in v.name, tf.trainable_variables())
 
             self.training_weight = tf.Variable(float(learning_rate), trainable=False, name="training_weight")
-            self._feed_dict[self.training_weight] = np.array([1.0], dtype=np.float32)
+            self._training_weight_in = np.array([1.0], dtype=np.float32)
+            self._feed_dict[self.training_weight] = self._training_weight_in
             with tf.device("/cpu:0"):
                 #clipped_gradients = _clip_by_value(self.grads, -max_grad, max_grad)
                 if is_batch_training:
@@ -63,15 +109,26 @@ class AbstractKBScoringModel:
                                                                                 param.get_shape(), param.dtype,
                                                                                 tf.constant_initializer(0.0), False),
                                                   train_params)
+                        # count gradients per row of embedding tables, so that only rows with gradients get updated
+                        self._acc_row_counts = [tf.get_variable(param.name.split(":")[0] + "_rows",
+                                                                [param.get_shape()[0]], tf.float32,
+                                                                tf.constant_initializer(0.0), False)
+                                                if isinstance(grad, tf.IndexedSlices) else None
+                                                for param, grad in zip(train_params, self._grads)]
                     self._loss = tf.get_variable("acc_loss", (), tf.float32, tf.constant_initializer(0.0), False)
                     # We abuse the gradient descent optimizer for accumulating gradients and loss (summing)
                     acc_opt = tf.train.GradientDescentOptimizer(-1.0)
-                    self._accumulate_gradients = acc_opt.apply_gradients(zip(self._grads, self._acc_gradients))
+                    row_counts = [(tf.IndexedSlices(tf.ones(tf.shape(grad.indices)), grad.indices), counts)
+                                  for grad, counts in zip(self._grads, self._acc_row_counts) if counts is not None]
+                    self._accumulate_gradients = acc_opt.apply_gradients(zip(self._grads, self._acc_gradients) +
+                                                                         row_counts)
                     self._acc_loss = acc_opt.apply_gradients([(loss, self._loss)])
 
-                    self._update = self.opt.apply_gradients(
-                        zip(map(lambda v: v.value(), self._acc_gradients), train_params), global_step=self.global_step)
+                    acc_grads = [tf_util.accumulated_rows(acc, counts) if counts is not None else acc.value()
+                                 for acc, counts in zip(self._acc_gradients, self._acc_row_counts)]
+                    self._update = self.opt.apply_gradients(zip(acc_grads, train_params), global_step=self.global_step)
                     self._reset = map(lambda param: param.initializer, self._acc_gradients)
+                    self._reset.extend(counts.initializer for counts in self._acc_row_counts if counts is not None)
                     self._reset.append(self._loss.initializer)
                 else:
                     self._loss = loss / math_ops.cast(num_pos, dtypes.float32)
@@ -90,7 +147,11 @@ class AbstractKBScoringModel:
                 l2_loss = l2_lambda * l2
                 if is_batch_training:
                     l2_grads = tf.gradients(l2_loss, train_params)
-                    self._l2_accumulate_gradients = acc_opt.apply_gradients(zip(l2_grads, self._acc_gradients))
+                    # l2 gradients are dense, so all rows have to be updated
+                    row_counts = [(tf.ones_like(counts), counts)
+                                  for counts in self._acc_row_counts if counts is not None]
+                    self._l2_accumulate_gradients = acc_opt.apply_gradients(zip(l2_grads, self._acc_gradients) +
+                                                                            row_counts)
                     self._l2_acc_loss = acc_opt.apply_gradients([(l2_loss, self._loss)])
                 else:
                     self._l2_update = tf.train.GradientDescentOptimizer(self.learning_rate).minimize(l2_loss, var_list=train_params)
@@ -100,6 +161,33 @@ class AbstractKBScoringModel:
     def _input_params(self):
         return None
 
+    def _lookup(self, params, ids_input, f=None):
+        '''
+        Embedding lookup, which gathers (and applies f to) every distinct id of ids_input only once, so gradients
+        of params contain one row per distinct id. The batch is expanded again within the graph.
+        :param ids_input: placeholder of ids, which is fed as unique ids and inverse index (see _dedup_feed_dict)
+        :return: f(embedding_lookup(params, ids_input))
+        '''
+        if ids_input not in self._dedup_inputs:
+            self._dedup_inputs[ids_input] = (tf.placeholder(tf.int64, shape=[None], name="unique_ids"),
+                                             tf.placeholder(tf.int64, shape=[None], name="inverse_ids"))
+        unique_input, inverse_input = self._dedup_inputs[ids_input]
+        embedded = tf.nn.embedding_lookup(params, unique_input)
+        if f is not None:
+            embedded = f(embedded)
+        return tf.gather(embedded, inverse_input)
+
+    def _dedup_feed_dict(self, feed_dict):
+        '''
+        Adds unique ids and inverse index for all id inputs in feed_dict that are looked up with _lookup.
+        :return: feed_dict
+        '''
+        for ids_input, (unique_input, inverse_input) in self._dedup_inputs.items():
+            if ids_input in feed_dict:
+                feed_dict[unique_input], feed_dict[inverse_input] = \
+                    np.unique(feed_dict[ids_input], return_inverse=True)
+        return feed_dict
+
     def name(self):
         return self.__class__.__name__
 
@@ -141,6 +229,13 @@ class AbstractKBScoringModel:
     def _get_feed_dict(self):
         return self._feed_dict
 
+    def _ids_feed_dict(self, rel_ids, subj_ids, obj_ids):
+        '''
+        :param rel_ids: int64 array of relation ids (kb dim 0), same for subj_ids (dim 1) and obj_ids (dim 2)
+        :return: new feed dict for this batch, does not touch the input buffers of the per-triple path
+        '''
+        return {self._rel_input: rel_ids, self._subj_input: subj_ids, self._obj_input: obj_ids}
+
     def score_triples(self, sess, triples):
         i = 0
         result = np.zeros([len(triples)])
@@ -151,7 +246,39 @@ class AbstractKBScoringModel:
                 self._add_triple_to_input(triples[i+j], j)
             self._finish_adding_triples(batch_size)
 
-            result[i:i+batch_size] = sess.run(self._scores, feed_dict=self._get_feed_dict())
+            result[i:i+batch_size] = sess.run(self._scores, feed_dict=self._dedup_feed_dict(self._get_feed_dict()))
+            i += batch_size
+
+        return result
+
+    def _score_variables(self, sess, *names):
+        '''
+        :return: current values of the variables with the given names created in _scoring_f
+        '''
+        with vs.variable_scope(self._score_scope, reuse=True):
+            variables = [tf.get_variable(name) for name in names]
+        return sess.run(variables)
+
+    def export_arrays(self, sess):
+        '''
+        :return: dict of all arrays needed for scoring without tensorflow, see np_scoring
+        '''
+        raise NotImplementedError("Export is not supported by %s." % self.name())
+
+    def score_ids(self, sess, rel_ids, subj_ids, obj_ids):
+        '''
+        Same as score_triples for triples given as id arrays.
+        '''
+        rel_ids = np.asarray(rel_ids, dtype=np.int64)
+        subj_ids = np.asarray(subj_ids, dtype=np.int64)
+        obj_ids = np.asarray(obj_ids, dtype=np.int64)
+        i = 0
+        result = np.zeros([len(rel_ids)])
+        while i < len(rel_ids):
+            batch_size = min(self._batch_size, len(rel_ids)-i)
+            feed_dict = self._ids_feed_dict(rel_ids[i:i+batch_size], subj_ids[i:i+batch_size],
+                                            obj_ids[i:i+batch_size])
+            result[i:i+batch_size] = sess.run(self._scores, feed_dict=self._dedup_feed_dict(feed_dict))
             i += batch_size
 
         return result
@@ -166,7 +293,7 @@ class AbstractKBScoringModel:
         '''
         assert self._is_train or self._is_batch_training, "model has to be created in training mode!"
 
-        assert len(pos_triples) + reduce(lambda acc, x: acc+len(x), neg_triples, 0) == self._batch_size, \
+        assert len(pos_triples) + sum(len(negs) for negs in neg_triples) == self._batch_size, \
             "batch_size and provided batch do not fit"
 
         j = 0
@@ -180,14 +307,81 @@ class AbstractKBScoringModel:
 
         self._finish_adding_triples(j)
 
+        return self._run_step(sess, self._get_feed_dict(), mode)
+
+    def _init_shared_neg_inputs(self):
+        self._neg_subj_input = tf.placeholder(tf.int64, shape=[self._num_shared_neg], name="neg_subj")
+        self._neg_obj_input = tf.placeholder(tf.int64, shape=[self._num_shared_neg], name="neg_obj")
+        # added to scores of negatives, very negative for negatives that are actually true
+        self._neg_subj_mask_input = tf.placeholder(tf.float32, shape=[None, self._num_shared_neg],
+                                                   name="neg_subj_mask")
+        self._neg_obj_mask_input = tf.placeholder(tf.float32, shape=[None, self._num_shared_neg],
+                                                  name="neg_obj_mask")
+        self._train_fact_keys = kb_index.index_cache(self._kb).fact_keys(["train"])
+
+    def _shared_neg_scores_f(self):
+        """
+        Called within the (reusing) variable scope of _scoring_f.
+        :return: two num_pos x num_shared_neg tensors of scores of all positive triples with each negative subject
+        (self._neg_subj_input) and negative object (self._neg_obj_input)
+        """
+        raise NotImplementedError("Shared negatives are not supported by %s." % self.name())
+
+    def _shared_neg_mask(self, rel_ids, subj_ids, obj_ids, neg_subj_ids, neg_obj_ids):
+        fact_keys = kb_index.fact_keys(self._kb, rel_ids[:, None], neg_subj_ids[None, :], obj_ids[:, None])
+        false_neg_subj = (kb_index.find_sorted(self._train_fact_keys, fact_keys) >= 0) | \
+                         (neg_subj_ids[None, :] == subj_ids[:, None])
+        fact_keys = kb_index.fact_keys(self._kb, rel_ids[:, None], subj_ids[:, None], neg_obj_ids[None, :])
+        false_neg_obj = (kb_index.find_sorted(self._train_fact_keys, fact_keys) >= 0) | \
+                        (neg_obj_ids[None, :] == obj_ids[:, None])
+        return np.where(false_neg_subj, -1e6, 0.0).astype(np.float32), \
+               np.where(false_neg_obj, -1e6, 0.0).astype(np.float32)
+
+    def step_shared(self, sess, pos_triples, neg_subjs, neg_objs, mode="update"):
+        '''
+        Training step of models created with num_shared_neg > 0. Every positive triple is scored against all
+        negative subjects and all negative objects, except for those that form training facts with it.
+        :param neg_subjs: list of num_shared_neg subject keys
+        :param neg_objs: list of num_shared_neg object keys
+        '''
+        assert self._is_train and self._num_shared_neg > 0, "model has to be created with shared negatives!"
+        assert len(neg_subjs) == len(neg_objs) == self._num_shared_neg, "wrong number of shared negatives"
+        ids = np.array([self._kb.get_ids(*t) for t in pos_triples], dtype=np.int64)
+        rel_ids, subj_ids, obj_ids = ids[:, 0], ids[:, 1], ids[:, 2]
+        neg_subj_ids = np.array([self._kb.get_id(x, 1) for x in neg_subjs], dtype=np.int64)
+        neg_obj_ids = np.array([self._kb.get_id(x, 2) for x in neg_objs], dtype=np.int64)
+
+        feed_dict = self._ids_feed_dict(rel_ids, subj_ids, obj_ids)
+        feed_dict[self.training_weight] = self._training_weight_in
+        feed_dict[self._neg_subj_input] = neg_subj_ids
+        feed_dict[self._neg_obj_input] = neg_obj_ids
+        feed_dict[self._neg_subj_mask_input], feed_dict[self._neg_obj_mask_input] = \
+            self._shared_neg_mask(rel_ids, subj_ids, obj_ids, neg_subj_ids, neg_obj_ids)
+        return self._run_step(sess, feed_dict, mode)
+
+    def step_ids(self, sess, rel_ids, subj_ids, obj_ids, mode="update"):
+        '''
+        Same as step for a batch given as id arrays, in which every positive triple is followed by its negatives.
+        '''
+        assert self._is_train or self._is_batch_training, "model has to be created in training mode!"
+        assert len(rel_ids) == len(subj_ids) == len(obj_ids) == self._batch_size, \
+            "batch_size and provided batch do not fit"
+
+        feed_dict = self._ids_feed_dict(np.asarray(rel_ids, dtype=np.int64), np.asarray(subj_ids, dtype=np.int64),
+                                        np.asarray(obj_ids, dtype=np.int64))
+        feed_dict[self.training_weight] = self._training_weight_in
+        return self._run_step(sess, feed_dict, mode)
+
+    def _run_step(self, sess, feed_dict, mode):
+        feed_dict = self._dedup_feed_dict(feed_dict)
         if mode == "loss":
-            return sess.run(self._loss, feed_dict=self._get_feed_dict())
+            return sess.run(self._loss, feed_dict=feed_dict)
         elif mode == "accumulate":
             assert self._is_batch_training, "accumulate only possible during batch training."
-            sess.run([self._accumulate_gradients, self._acc_loss], feed_dict=self._get_feed_dict())
+            sess.run([self._accumulate_gradients, self._acc_loss], feed_dict=feed_dict)
             return 0.0
         else:
-            return sess.run([self._loss, self._update], feed_dict=self._get_feed_dict())[0]
+            return sess.run([self._loss, self._update], feed_dict=feed_dict)[0]
 
     def acc_l2_gradients(self, sess):
         assert self._is_batch_training, "acc_l2_gradients only possible during batch training."
@@ -211,15 +405,31 @@ class DistMult(AbstractKBScoringModel):
             E_objs = tf.get_variable("E_o", [len(self._kb.get_symbols(2)), self._size])
             E_rels = tf.get_variable("E_r", [len(self._kb.get_symbols(0)), self._size])
 
-        self.e_subj = tf.tanh(tf.nn.embedding_lookup(E_subjs, self._subj_input))
-        self.e_obj = tf.tanh(tf.nn.embedding_lookup(E_objs, self._obj_input))
-        self.e_rel = tf.sigmoid(tf.nn.embedding_lookup(E_rels, self._rel_input))
+        self.e_subj = self._lookup(E_subjs, self._subj_input, tf.tanh)
+        self.e_obj = self._lookup(E_objs, self._obj_input, tf.tanh)
+        self.e_rel = self._lookup(E_rels, self._rel_input, tf.sigmoid)
         s_o_prod = self.e_obj * self.e_subj
 
         score = tf_util.batch_dot(self.e_rel, s_o_prod)
 
         return score
 
+    def _shared_neg_scores_f(self):
+        with tf.device("/cpu:0"):
+            E_subjs = tf.get_variable("E_s", [len(self._kb.get_symbols(1)), self._size])
+            E_objs = tf.get_variable("E_o", [len(self._kb.get_symbols(2)), self._size])
+
+        e_neg_subj = tf.tanh(tf.nn.embedding_lookup(E_subjs, self._neg_subj_input))
+        e_neg_obj = tf.tanh(tf.nn.embedding_lookup(E_objs, self._neg_obj_input))
+        subj_scores = tf.matmul(self.e_rel * self.e_obj, e_neg_subj, transpose_b=True)
+        obj_scores = tf.matmul(self.e_rel * self.e_subj, e_neg_obj, transpose_b=True)
+
+        return subj_scores, obj_scores
+
+    def export_arrays(self, sess):
+        E_subjs, E_objs, E_rels = self._score_variables(sess, "E_s", "E_o", "E_r")
+        return {"subj": np.tanh(E_subjs), "obj": np.tanh(E_objs), "rel": 1.0 / (1.0 + np.exp(-E_rels))}
+
 
 class ModelE(AbstractKBScoringModel):
 
@@ -230,104 +440,99 @@ class ModelE(AbstractKBScoringModel):
             E_rels_s = tf.get_variable("E_r_s", [len(self._kb.get_symbols(0)), self._size])
             E_rels_o = tf.get_variable("E_r_o", [len(self._kb.get_symbols(0)), self._size])
 
-        self.e_subj = tf.tanh(tf.nn.embedding_lookup(E_subjs, self._subj_input))
-        self.e_obj = tf.tanh(tf.nn.embedding_lookup(E_objs, self._obj_input))
-        self.e_rel_s = tf.tanh(tf.nn.embedding_lookup(E_rels_s, self._rel_input))
-        self.e_rel_o = tf.tanh(tf.nn.embedding_lookup(E_rels_o, self._rel_input))
+        self.e_subj = self._lookup(E_subjs, self._subj_input, tf.tanh)
+        self.e_obj = self._lookup(E_objs, self._obj_input, tf.tanh)
+        self.e_rel_s = self._lookup(E_rels_s, self._rel_input, tf.tanh)
+        self.e_rel_o = self._lookup(E_rels_o, self._rel_input, tf.tanh)
 
         score = tf_util.batch_dot(self.e_rel_s, self.e_subj) + tf_util.batch_dot(self.e_rel_o, self.e_obj)
 
         return score
 
+    def _shared_neg_scores_f(self):
+        with tf.device("/cpu:0"):
+            E_subjs = tf.get_variable("E_s", [len(self._kb.get_symbols(1)), self._size])
+            E_objs = tf.get_variable("E_o", [len(self._kb.get_symbols(2)), self._size])
+
+        e_neg_subj = tf.tanh(tf.nn.embedding_lookup(E_subjs, self._neg_subj_input))
+        e_neg_obj = tf.tanh(tf.nn.embedding_lookup(E_objs, self._neg_obj_input))
+        # the score is a sum of a subject and an object part, only one of which changes per position
+        subj_part = tf.expand_dims(tf_util.batch_dot(self.e_rel_s, self.e_subj), 1)
+        obj_part = tf.expand_dims(tf_util.batch_dot(self.e_rel_o, self.e_obj), 1)
+        subj_scores = tf.matmul(self.e_rel_s, e_neg_subj, transpose_b=True) + obj_part
+        obj_scores = tf.matmul(self.e_rel_o, e_neg_obj, transpose_b=True) + subj_part
+
+        return subj_scores, obj_scores
+
+    def export_arrays(self, sess):
+        E_subjs, E_objs, E_rels_s, E_rels_o = self._score_variables(sess, "E_s", "E_o", "E_r_s", "E_r_o")
+        return {"subj": np.tanh(E_subjs), "obj": np.tanh(E_objs),
+                "rel_s": np.tanh(E_rels_s), "rel_o": np.tanh(E_rels_o)}
+
 
 class ModelO(AbstractKBScoringModel):
 
     def __init__(self, kb, size, batch_size, is_train=True, num_neg=200, learning_rate=1e-2, l2_lambda=0.0,
-                 is_batch_training=False, which_sets=["train_text"]):
+                 is_batch_training=False, which_sets=["train_text"], optimizer="Adam"):
         self._which_sets = set(which_sets)
         AbstractKBScoringModel.__init__(self, kb, size, batch_size, is_train=True, num_neg=200, learning_rate=1e-2,
-                                        l2_lambda=0.0, is_batch_training=False)
+                                        l2_lambda=0.0, is_batch_training=False, optimizer=optimizer)
 
     def _init_inputs(self):
-        self._rel_ids = dict()
-        # create tuple to rel lookup
-        self._tuple_rels_lookup = dict()
-        for (rel, subj, obj), _, typ in self._kb.get_all_facts():
-            if typ in self._which_sets:
-                if rel not in self._rel_ids:
-                    self._rel_ids[rel] = len(self._rel_ids)
-                s_i = self._kb.get_id(subj, 1)
-                o_i = self._kb.get_id(obj, 2)
-                r_i = self._rel_ids[rel]
-                t = (s_i, o_i)
-                if t not in self._tuple_rels_lookup:
-                    self._tuple_rels_lookup[t] = [r_i]
-                else:
-                    self._tuple_rels_lookup[t].append(r_i)
-
+        # create tuple to rels lookup, which also contains inverse relations of tuples
+        cache = kb_index.index_cache(self._kb)
+        observed, self._tuple_rels = cache.tuple_rels(self._which_sets)
+        self._num_args = cache.num_args
+        self._rel_ids = dict((self._kb.get_key(r_i, 0), i) for i, r_i in enumerate(observed))
         self._num_relations = len(self._rel_ids)
-
-        #also add inverse relations to tuples
-        for (rel, subj, obj), _, typ in self._kb.get_all_facts():
-            if typ in self._which_sets:
-                if rel not in self._rel_ids:
-                    self._rel_ids[rel] = len(self._rel_ids)
-                s_i = self._kb.get_id(subj, 1)
-                o_i = self._kb.get_id(obj, 2)
-                r_i = self._rel_ids[rel] + self._num_relations
-                t = (o_i, s_i)
-                if t not in self._tuple_rels_lookup:
-                    self._tuple_rels_lookup[t] = [r_i]
-                else:
-                    self._tuple_rels_lookup[t].append(r_i)
+        # observed relation id of every kb relation, -1 if it is not observed
+        self._kb_rel_obs_ids = np.zeros([self._kb.dim_size(0)], dtype=np.int64) - 1
+        self._kb_rel_obs_ids[observed] = np.arange(len(observed))
 
         self._rel_input = tf.placeholder(tf.int64, shape=[None], name="rel")
         self._rel_in = np.zeros([self._batch_size], dtype=np.int64)
+        self._subj_in = np.zeros([self._batch_size], dtype=np.int64)
+        self._obj_in = np.zeros([self._batch_size], dtype=np.int64)
         self._sparse_indices_input = tf.placeholder(tf.int64, name="sparse_indices")
         self._sparse_values_input = tf.placeholder(tf.int64, name="sparse_values")
         self._shape_input = tf.placeholder(tf.int64, name="shape")
         self._feed_dict = {}
 
-    def _start_adding_triples(self):
-        self._sparse_indices = []
-        self._sparse_values = []
-        self._max_cols = 1
+    def _finish_adding_triples(self, batch_size):
+        self._feed_dict.update(self._ids_feed_dict(self._rel_in[:batch_size], self._subj_in[:batch_size],
+                                                   self._obj_in[:batch_size]))
 
-    def _add_triple_to_input(self, t, j):
-        (rel, subj, obj) = t
-        r_i = self._kb.get_id(rel, 0)
-        self._rel_in[j] = r_i
-        s_i = self._kb.get_id(subj, 1)
-        o_i = self._kb.get_id(obj, 2)
+    def _observed_values(self, rel_ids, batch_pos, rels):
+        '''
+        :return: mask of the observed relations that are used as features and their feature ids
+        '''
+        # the scored relation itself is not observed
+        return rels != self._kb_rel_obs_ids[rel_ids][batch_pos], rels
 
-        rels = self._tuple_rels_lookup.get((s_i, o_i))
-        if rels:
-            for i in xrange(len(rels)):
-                if rels[i] != self._rel_ids.get(rel):
-                    self._sparse_indices.append([j, i])
-                    self._sparse_values.append(rels[i])
-            self._max_cols = max(self._max_cols, len(rels) + 1)
-            # default relation
-            self._sparse_indices.append([j, len(rels)])
-        else:
-            self._sparse_indices.append([j, 0])
-        self._sparse_values.append(2 * self._num_relations)
+    def _default_value(self):
+        return 2 * self._num_relations
 
-    def _finish_adding_triples(self, batch_size):
-        self._feed_dict[self._sparse_indices_input] = self._sparse_indices
-        self._feed_dict[self._sparse_values_input] = self._sparse_values
-        self._feed_dict[self._shape_input] = [batch_size, self._max_cols]
-        if batch_size < self._batch_size:
-            self._feed_dict[self._rel_input] = self._rel_in[:batch_size]
-        else:
-            self._feed_dict[self._rel_input] = self._rel_in
+    def _observed_features(self, rel_ids, subj_ids, obj_ids):
+        '''
+        :return: sparse indices and values of the observed features of each triple and the max number of columns
+        '''
+        batch_pos, cols, rels, counts = self._tuple_rels.gather(kb_index.pack_pairs(subj_ids, obj_ids, self._num_args))
+        keep, values = self._observed_values(rel_ids, batch_pos, rels)
+        return kb_index.sparse_features(batch_pos[keep], cols[keep], values[keep], counts, self._default_value())
+
+    def _ids_feed_dict(self, rel_ids, subj_ids, obj_ids):
+        sparse_indices, sparse_values, max_cols = self._observed_features(rel_ids, subj_ids, obj_ids)
+        return {self._rel_input: rel_ids,
+                self._sparse_indices_input: sparse_indices,
+                self._sparse_values_input: sparse_values,
+                self._shape_input: [len(rel_ids), max_cols]}
 
     def _scoring_f(self):
         with tf.device("/cpu:0"):
            E_rels = tf.get_variable("E_r", [len(self._kb.get_symbols(0)), self._size])
            E_tup_rels = tf.get_variable("E_tup_r", [2 * self._num_relations + 1, self._size])  # rels + inv rels + default rel
 
-        self.e_rel = tf.tanh(tf.nn.embedding_lookup(E_rels, self._rel_input))
+        self.e_rel = self._lookup(E_rels, self._rel_input, tf.tanh)
         # weighted sum of tuple rel embeddings
         sparse_tensor = tf.SparseTensor(self._sparse_indices_input, self._sparse_values_input, self._shape_input)
         # mean embedding
@@ -335,6 +540,13 @@ class ModelO(AbstractKBScoringModel):
 
         return tf_util.batch_dot(self.e_rel, self.e_tuple_rels)
 
+    def export_arrays(self, sess):
+        E_rels, E_tup_rels = self._score_variables(sess, "E_r", "E_tup_r")
+        return {"rel": np.tanh(E_rels), "tup_rels": E_tup_rels, "num_args": np.array(self._num_args),
+                "kb_rel_obs_ids": self._kb_rel_obs_ids, "default_value": np.array(self._default_value()),
+                "tuple_rels_keys": self._tuple_rels.keys, "tuple_rels_offsets": self._tuple_rels.offsets,
+                "tuple_rels_values": self._tuple_rels.values}
+
 
 class WeightedModelO(ModelO):
 
@@ -342,9 +554,10 @@ class WeightedModelO(ModelO):
         ModelO._init_inputs(self)
         self._gather_rels_input = tf.placeholder(tf.int64, name="gathered_rels")
 
-    def _finish_adding_triples(self, batch_size):
-        ModelO._finish_adding_triples(self, batch_size)
-        self._feed_dict[self._gather_rels_input] = map(lambda x: x[0], self._sparse_indices)
+    def _ids_feed_dict(self, rel_ids, subj_ids, obj_ids):
+        feed_dict = ModelO._ids_feed_dict(self, rel_ids, subj_ids, obj_ids)
+        feed_dict[self._gather_rels_input] = feed_dict[self._sparse_indices_input][:, 0]
+        return feed_dict
 
     def _scoring_f(self):
         with tf.device("/cpu:0"):
@@ -352,8 +565,8 @@ class WeightedModelO(ModelO):
            E_tup_rels = tf.get_variable("E_tup_r", [2 * self._num_relations + 1, self._size])  # rels + inv rels + default rel
 
         # duplicate rels to fit with observations
-        e_rel = tf.gather(tf.tanh(tf.nn.embedding_lookup(E_rels, self._rel_input)), self._gather_rels_input)
-        e_tup_rels = tf.tanh(tf.nn.embedding_lookup(E_tup_rels, self._sparse_values_input))
+        e_rel = tf.gather(self._lookup(E_rels, self._rel_input, tf.tanh), self._gather_rels_input)
+        e_tup_rels = self._lookup(E_tup_rels, self._sparse_values_input, tf.tanh)
 
         scores_flat = tf_util.batch_dot(e_rel, e_tup_rels)
         # for softmax set empty cells to something very small, so weight becomes practically zero
@@ -375,8 +588,8 @@ class BlurWeightedModelO(WeightedModelO):
         blur_factor = tf.get_variable("blur", shape=[1], initializer=tf.constant_initializer(0.0))
         blur_factor = tf.sigmoid(blur_factor)
         # duplicate rels to fit with observations
-        e_rel = tf.gather(tf.tanh(tf.nn.embedding_lookup(E_rels, self._rel_input)), self._gather_rels_input)
-        e_tup_rels = tf.tanh(tf.nn.embedding_lookup(E_tup_rels, self._sparse_values_input))
+        e_rel = tf.gather(self._lookup(E_rels, self._rel_input, tf.tanh), self._gather_rels_input)
+        e_tup_rels = self._lookup(E_tup_rels, self._sparse_values_input, tf.tanh)
 
         scores_flat = tf_util.batch_dot(e_rel, e_tup_rels)
         # for softmax set empty cells to something very small, so weight becomes practically zero
@@ -392,46 +605,22 @@ class ModelN(ModelO):
 
     def _init_inputs(self):
         ModelO._init_inputs(self)
-        self._rel_cooc_lookup = dict()
-        for (rel, subj, obj), _, typ in self._kb.get_all_facts():
-            s_i = self._kb.get_id(subj, 1)
-            o_i = self._kb.get_id(obj, 2)
-            if rel not in self._rel_ids:
-                self._rel_ids[rel] = len(self._rel_ids)
-            r_i = self._rel_ids[rel]
-            t = (s_i, o_i)
-            rels = self._tuple_rels_lookup.get(t)
-            if rels:
-                for rel2 in rels:
-                    if r_i != rel2:
-                        rel_cooc = (r_i, rel2)
-                        if rel_cooc not in self._rel_cooc_lookup:
-                            self._rel_cooc_lookup[rel_cooc] = len(self._rel_cooc_lookup)
+        # co-occurrences of relations of facts with the relations observed for their tuple
+        self._kb_rel_n_ids, self._num_cooc_rels, self._rel_cooc_keys = \
+            kb_index.index_cache(self._kb).rel_coocs(self._which_sets)
 
-    def _add_triple_to_input(self, t, j):
-        (rel, subj, obj) = t
-        r_i = self._rel_ids.get(rel, 0)
-        s_i = self._kb.get_id(subj, 1)
-        o_i = self._kb.get_id(obj, 2)
+    def _observed_values(self, rel_ids, batch_pos, rels):
+        rels_of_triples = self._kb_rel_n_ids[rel_ids][batch_pos]
+        cooc_keys = kb_index.pack_pairs(rels_of_triples, rels, self._num_cooc_rels)
+        cooc_ids = kb_index.find_sorted(self._rel_cooc_keys, cooc_keys)
+        return (rels_of_triples != rels) & (cooc_ids >= 0), cooc_ids
 
-        rels = self._tuple_rels_lookup.get((s_i, o_i))
-        if rels:
-            for i in xrange(len(rels)):
-                if rels[i] != r_i:
-                    cooc_id = self._rel_cooc_lookup.get((r_i, rels[i]))
-                    if cooc_id:
-                        self._sparse_indices.append([j, i])
-                        self._sparse_values.append(cooc_id)
-            self._max_cols = max(self._max_cols, len(rels) + 1)
-            # default relation
-            self._sparse_indices.append([j, len(rels)])
-        else:
-            self._sparse_indices.append([j, 0])
-        self._sparse_values.append(len(self._rel_cooc_lookup))
+    def _default_value(self):
+        return len(self._rel_cooc_keys)
 
     def _scoring_f(self):
         with tf.device("/cpu:0"):
-           E_neighbour_weights = tf.get_variable("E_tup_r", [len(self._rel_cooc_lookup) + 1, 1])
+           E_neighbour_weights = tf.get_variable("E_tup_r", [len(self._rel_cooc_keys) + 1, 1])
 
         # weighted sum of tuple rel embeddings
         sparse_tensor = tf.SparseTensor(self._sparse_indices_input, self._sparse_values_input, self._shape_input)
@@ -444,53 +633,62 @@ class ModelN(ModelO):
 class ModelF(AbstractKBScoringModel):
 
     def _init_inputs(self):
-        # create tuple to rel lookup
-        self.__tuple_lookup = dict()
-        for (rel, subj, obj), _, typ in self._kb.get_all_facts():
-            if typ.startswith("train"):
-                s_i = self._kb.get_id(subj, 1)
-                o_i = self._kb.get_id(obj, 2)
-                t = (s_i, o_i)
-                if t not in self.__tuple_lookup:
-                    self.__tuple_lookup[t] = len(self.__tuple_lookup)
+        # tuple id is the position of its packed key, all tuples not seen in training share the last (OOV) id
+        cache = kb_index.index_cache(self._kb)
+        self._num_args = cache.num_args
+        self._tuple_keys = cache.tuple_keys([typ for typ in cache.fact_types() if typ.startswith("train")])
+        self._oov_tuple_id = len(self._tuple_keys)
 
         self._rel_input = tf.placeholder(tf.int64, shape=[None], name="rel")
         self._rel_in = np.zeros([self._batch_size], dtype=np.int64)
         self._tuple_input = tf.placeholder(tf.int64, shape=[None], name="tuple")
-        self._tuple_in = np.zeros([self._batch_size], dtype=np.int64)
+        self._tuple_key_in = np.zeros([self._batch_size], dtype=np.int64)
         self._feed_dict = {}
 
+    def _tuple_ids(self, tuple_keys):
+        tuple_ids = kb_index.find_sorted(self._tuple_keys, tuple_keys)
+        return np.where(tuple_ids >= 0, tuple_ids, self._oov_tuple_id)
+
     def _add_triple_to_input(self, t, j):
         (rel, subj, obj) = t
         r_i = self._kb.get_id(rel, 0)
         self._rel_in[j] = r_i
         s_i = self._kb.get_id(subj, 1)
         o_i = self._kb.get_id(obj, 2)
-        self._tuple_in[j] = self.__tuple_lookup[(s_i, o_i)]
+        self._tuple_key_in[j] = s_i * self._num_args + o_i
 
     def _finish_adding_triples(self, batch_size):
         if batch_size < self._batch_size:
             self._feed_dict[self._rel_input] = self._rel_in[:batch_size]
-            self._feed_dict[self._tuple_input] = self._tuple_in[:batch_size]
+            self._feed_dict[self._tuple_input] = self._tuple_ids(self._tuple_key_in[:batch_size])
         else:
             self._feed_dict[self._rel_input] = self._rel_in
-            self._feed_dict[self._tuple_input] = self._tuple_in
+            self._feed_dict[self._tuple_input] = self._tuple_ids(self._tuple_key_in)
+
+    def _ids_feed_dict(self, rel_ids, subj_ids, obj_ids):
+        tuple_ids = self._tuple_ids(kb_index.pack_pairs(subj_ids, obj_ids, self._num_args))
+        return {self._rel_input: rel_ids, self._tuple_input: tuple_ids}
 
     def _scoring_f(self):
         with tf.device("/cpu:0"):
            E_rels = tf.get_variable("E_r", [len(self._kb.get_symbols(0)), self._size])
-           E_tups = tf.get_variable("E_t", [len(self.__tuple_lookup), self._size])
+           E_tups = tf.get_variable("E_t", [len(self._tuple_keys) + 1, self._size])
 
-        self.e_rel = tf.tanh(tf.nn.embedding_lookup(E_rels, self._rel_input))
-        self.e_tup = tf.tanh(tf.nn.embedding_lookup(E_tups, self._tuple_input))
+        self.e_rel = self._lookup(E_rels, self._rel_input, tf.tanh)
+        self.e_tup = self._lookup(E_tups, self._tuple_input, tf.tanh)
 
         return tf_util.batch_dot(self.e_rel, self.e_tup)
 
+    def export_arrays(self, sess):
+        E_rels, E_tups = self._score_variables(sess, "E_r", "E_t")
+        return {"rel": np.tanh(E_rels), "tup": np.tanh(E_tups), "num_args": np.array(self._num_args),
+                "tuple_keys": self._tuple_keys}
+
 
 class CombinedModel(AbstractKBScoringModel):
 
     def __init__(self, models, kb, size, batch_size, is_train=True, num_neg=200, learning_rate=1e-2, l2_lambda=0.0,
-                 is_batch_training=False, composition=None, share_vars=False):
+                 is_batch_training=False, composition=None, share_vars=False, optimizer="Adam"):
         self._models = []
         self.__name = '_'.join(models)
         if composition:
@@ -501,7 +699,7 @@ class CombinedModel(AbstractKBScoringModel):
                                                        l2_lambda, False, composition=composition, type=m))
 
         AbstractKBScoringModel.__init__(self, kb, size, batch_size, is_train, num_neg, learning_rate,
-                                        l2_lambda, is_batch_training)
+                                        l2_lambda, is_batch_training, optimizer)
 
     def name(self):
         return self.__name
@@ -513,17 +711,25 @@ class CombinedModel(AbstractKBScoringModel):
             scores.append(self._models[i+1]._scores * weights[i])
         return tf.reduce_sum(tf.pack(scores), 0)
 
-    def _add_triple_to_input(self, t, j):
-        for m in self._models:
-            m._add_triple_to_input(t, j)
-
     def _finish_adding_triples(self, batch_size):
-        for m in self._models:
-            m._finish_adding_triples(batch_size)
-        for m in self._models:
-            self._feed_dict.update(m._get_feed_dict())
+        # ids are resolved once by _add_triple_to_input and shared by all sub-models
+        self._feed_dict.update(self._ids_feed_dict(self._rel_in[:batch_size], self._subj_in[:batch_size],
+                                                   self._obj_in[:batch_size]))
 
     def _start_adding_triples(self):
+        self._feed_dict = dict()
+        # fed 1.0 like every other training model and step_ids, otherwise gradients are scaled by the initial value
+        if hasattr(self, "training_weight"):
+            self._feed_dict[self.training_weight] = self._training_weight_in
+
+    def _ids_feed_dict(self, rel_ids, subj_ids, obj_ids):
+        # sub-models build their feeds concurrently, _ids_feed_dict of every sub-model returns a new dict
+        feed_dict = dict()
+        for fd in _shared_pool().map(lambda m: m._ids_feed_dict(rel_ids, subj_ids, obj_ids), self._models):
+            feed_dict.update(fd)
+        return feed_dict
+
+    def _dedup_feed_dict(self, feed_dict):
         for m in self._models:
-            m._start_adding_triples()
-        self._feed_dict = dict()
\ No newline at end of file
+            m._dedup_feed_dict(feed_dict)
+        return feed_dict
@@ -0,0 +1,46 @@
+"""Checks that step_ids trains a model exactly like step.
+Run from the repository root with: python -m model.test_models"""
+import unittest
+import numpy as np
+import tensorflow as tf
+import model
+from kb import KB
+
+
+def small_kb():
+    kb = KB()
+    for rel, subj, obj in [("r1", "e1", "e2"), ("r1", "e2", "e3"), ("r2", "e1", "e3"), ("r2", "e3", "e4")]:
+        kb.add(True, "train", rel, subj, obj)
+    return kb
+
+
+class CombinedModelStepTest(unittest.TestCase):
+
+    def test_step_ids_matches_step(self):
+        kb = small_kb()
+        pos = [("r1", "e1", "e2"), ("r2", "e3", "e4")]
+        negs = [[("r1", "e1", "e3"), ("r1", "e3", "e2")], [("r2", "e3", "e2"), ("r2", "e2", "e4")]]
+        triples = [pos[0]] + negs[0] + [pos[1]] + negs[1]
+        ids = np.array([kb.get_ids(*t) for t in triples], dtype=np.int64)
+        with tf.Graph().as_default(), tf.Session() as sess:
+            m = model.create_model(kb, 4, len(triples), num_neg=2, learning_rate=1e-2, type=["DistMult", "ModelE"])
+            sess.run(tf.initialize_all_variables())
+            variables = tf.all_variables()
+            initial = sess.run(variables)
+            self.assertAlmostEqual(m.step(sess, pos, negs, mode="loss"),
+                                   m.step_ids(sess, ids[:, 0], ids[:, 1], ids[:, 2], mode="loss"), places=5)
+
+            loss = m.step(sess, pos, negs)
+            after_step = sess.run(variables)
+            for v, value in zip(variables, initial):
+                sess.run(v.assign(value))
+            loss_ids = m.step_ids(sess, ids[:, 0], ids[:, 1], ids[:, 2])
+            after_step_ids = sess.run(variables)
+
+            self.assertAlmostEqual(loss, loss_ids, places=5)
+            for v, a, b in zip(variables, after_step, after_step_ids):
+                np.testing.assert_allclose(a, b, rtol=1e-5, atol=1e-6, err_msg=v.name)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,418 @@
+"""Scoring of trained DistMult, ModelE, ModelF and ModelO models with NumPy only. Models are exported once from a
+tensorflow session into an .npz file, which contains only the (activated) embedding tables, the indexes needed for
+scoring and the kb vocabularies. Embedding tables can be stored in float16 or per-row quantized int8, which are
+dequantized block-wise during scoring. predict_topk answers top-k queries, exactly or with an approximate IVF index
+for DistMult and ModelE."""
+import time
+import numpy as np
+import kb_index
+
+PRECISIONS = ["float32", "float16", "int8"]
+# number of triples that are scored (and whose embedding rows are dequantized) at once
+BLOCK_SIZE = 4096
+
+
+def quantize(arrays, tables, precision):
+    '''
+    :param arrays: dict of exported float32 arrays
+    :param tables: names of the embedding tables in arrays that are stored with precision
+    :param precision: "float32", "float16" or "int8". int8 tables are quantized symmetrically per row, the scale of
+    each row is stored in float32 under <name>__scale.
+    :return: new dict of arrays
+    '''
+    if precision not in PRECISIONS:
+        raise NameError("There is no precision %s. Possible values are %s." % (precision, ", ".join(PRECISIONS)))
+    arrays = dict(arrays)
+    for name in tables:
+        table = np.asarray(arrays[name], dtype=np.float32)
+        if precision == "float32":
+            arrays[name] = table
+        elif precision == "float16":
+            arrays[name] = table.astype(np.float16)
+        else:
+            scale = np.max(np.abs(table), axis=1) / 127.0
+            scale[scale == 0.0] = 1.0
+            arrays[name] = np.round(table / scale[:, None]).astype(np.int8)
+            arrays[name + "__scale"] = scale.astype(np.float32)
+    return arrays
+
+
+def _topk(ids, scores, k):
+    '''
+    :return: ids and scores of the k best scores, sorted by descending score
+    '''
+    if len(scores) > k:
+        top = np.argpartition(-scores, k - 1)[:k]
+        ids, scores = ids[top], scores[top]
+    order = np.argsort(-scores, kind="mergesort")
+    return ids[order], scores[order]
+
+
+class IVFIndex:
+    '''
+    Inverted file index over the rows of an embedding table. Rows are clustered by k-means, a query scores the
+    centroids and only the rows of the num_probe clusters with the highest inner product are searched.
+    '''
+
+    def __init__(self, rows_f, num_rows, num_clusters=None, num_iterations=10, seed=1234):
+        '''
+        :param rows_f: function returning float32 rows for an array of row ids
+        :param num_clusters: defaults to sqrt(num_rows)
+        '''
+        if num_clusters is None:
+            num_clusters = int(np.sqrt(num_rows))
+        num_clusters = max(1, min(num_clusters, num_rows))
+        rng = np.random.RandomState(seed)
+        self.centroids = rows_f(np.sort(rng.choice(num_rows, num_clusters, replace=False)))
+        for _ in xrange(num_iterations):
+            assignment = self._assign(rows_f, num_rows)
+            sums = np.zeros_like(self.centroids)
+            for start in xrange(0, num_rows, BLOCK_SIZE):
+                ids = np.arange(start, min(start + BLOCK_SIZE, num_rows))
+                np.add.at(sums, assignment[ids], rows_f(ids))
+            counts = np.bincount(assignment, minlength=num_clusters)
+            # empty clusters keep their centroid
+            non_empty = counts > 0
+            self.centroids[non_empty] = sums[non_empty] / counts[non_empty][:, None]
+        assignment = self._assign(rows_f, num_rows)
+        self.members = np.argsort(assignment, kind="mergesort")
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=num_clusters))])
+
+    def _assign(self, rows_f, num_rows):
+        # nearest centroid in euclidean distance: argmin |c|^2 - 2 x.c
+        sq_norms = np.sum(self.centroids * self.centroids, axis=1)
+        assignment = np.zeros([num_rows], dtype=np.int64)
+        for start in xrange(0, num_rows, BLOCK_SIZE):
+            ids = np.arange(start, min(start + BLOCK_SIZE, num_rows))
+            assignment[ids] = np.argmin(sq_norms - 2 * rows_f(ids).dot(self.centroids.T), axis=1)
+        return assignment
+
+    def probe(self, query, num_probe):
+        '''
+        :return: ids of all rows in the num_probe clusters whose centroids have the highest inner product with query
+        '''
+        clusters, _ = _topk(np.arange(len(self.centroids)), self.centroids.dot(query), num_probe)
+        return np.concatenate([self.members[self.offsets[c]:self.offsets[c + 1]] for c in clusters])
+
+
+def export(sess, kb, model, fn, precision="float32"):
+    '''
+    Writes everything needed for scoring with model to fn (.npz).
+    :param precision: storage of the embedding tables, see quantize
+    '''
+    if model.name() not in SCORERS:
+        raise NameError("Export is not supported for %s. Possible models are %s." %
+                        (model.name(), ", ".join(sorted(SCORERS))))
+    arrays = quantize(model.export_arrays(sess), SCORERS[model.name()].TABLES, precision)
+    for dim in xrange(3):
+        arrays["vocab_%d" % dim] = np.array(kb.get_vocab(dim))
+    np.savez(fn, model=np.array(model.name()), **arrays)
+
+
+def load_scorer(fn):
+    '''
+    :return: scorer for the model exported to fn
+    '''
+    arrays = np.load(fn)
+    return SCORERS[str(arrays["model"])](dict((k, arrays[k]) for k in arrays.files))
+
+
+class NumpyScorer:
+    # names of the embedding tables, which may be stored with reduced precision
+    TABLES = []
+
+    def __init__(self, arrays):
+        self._arrays = arrays
+        self._vocabs = [arrays["vocab_%d" % dim] for dim in xrange(3)]
+        self._ids = [None, None, None]
+        self._indexes = dict()
+
+    def get_ids(self, rel, subj, obj):
+        '''
+        :return: ids of the keys of a triple, like KB.get_ids
+        '''
+        return [self.vocab_ids(dim, [key])[0] for dim, key in enumerate((rel, subj, obj))]
+
+    def score_triples(self, triples):
+        ids = np.array([self.get_ids(*t) for t in triples], dtype=np.int64).reshape([-1, 3])
+        return self.score_ids(ids[:, 0], ids[:, 1], ids[:, 2])
+
+    def _vocab_index(self, dim):
+        if self._ids[dim] is None:
+            self._ids[dim] = dict((k, i) for i, k in enumerate(self._vocabs[dim].tolist()))
+        return self._ids[dim]
+
+    def vocab_ids(self, dim, keys):
+        '''
+        :return: array with the id of each key of dim
+        '''
+        index = self._vocab_index(dim)
+        return np.array([index[k] for k in keys], dtype=np.int64)
+
+    def with_precision(self, precision):
+        '''
+        :return: scorer of the same model with its float32 tables stored with precision, see quantize
+        '''
+        for name in self.TABLES:
+            assert self._arrays[name].dtype == np.float32, "Tables of this scorer are already stored with reduced " \
+                                                           "precision."
+        return self.__class__(quantize(self._arrays, self.TABLES, precision))
+
+    def table_bytes(self):
+        '''
+        :return: number of bytes of all embedding tables, including scales
+        '''
+        return sum(a.nbytes for name, a in self._arrays.iteritems()
+                   if name in self.TABLES or name.endswith("__scale"))
+
+    def _rows(self, name, ids):
+        '''
+        :return: float32 rows ids of table name
+        '''
+        rows = self._arrays[name][ids].astype(np.float32)
+        scale = self._arrays.get(name + "__scale")
+        if scale is not None:
+            rows *= scale[ids][:, None]
+        return rows
+
+    def score_ids(self, rel_ids, subj_ids, obj_ids):
+        '''
+        :return: scores of all triples given by id arrays, same as score_ids of the exported model
+        '''
+        rel_ids = np.asarray(rel_ids, dtype=np.int64)
+        subj_ids = np.asarray(subj_ids, dtype=np.int64)
+        obj_ids = np.asarray(obj_ids, dtype=np.int64)
+        scores = np.zeros([len(rel_ids)], dtype=np.float32)
+        for start in xrange(0, len(rel_ids), BLOCK_SIZE):
+            end = start + BLOCK_SIZE
+            scores[start:end] = self._score_block(rel_ids[start:end], subj_ids[start:end], obj_ids[start:end])
+        return scores
+
+    def _score_block(self, rel_ids, subj_ids, obj_ids):
+        raise NotImplementedError()
+
+    def _linear_query(self, rel_id, arg_id, position):
+        '''
+        Scores of a query that are linear in the embeddings of the predicted arguments, score = const + query.row.
+        :return: name of the table of predicted arguments, query vector and const, or None if the model has no such
+        form
+        '''
+        return None
+
+    def build_index(self, position="obj", num_clusters=None, num_iterations=10, seed=1234):
+        '''
+        Builds an IVF index over the embeddings of subjects (position="subj") or objects (position="obj"), which
+        predict_topk uses for queries of this position.
+        '''
+        linear = self._linear_query(0, 0, position)
+        if linear is None:
+            raise NotImplementedError("Approximate top-k search is not supported for this model.")
+        name = linear[0]
+        self._indexes[position] = IVFIndex(lambda ids: self._rows(name, ids), len(self._arrays[name]),
+                                           num_clusters, num_iterations, seed)
+
+    def predict_topk(self, rel, arg, k, position="obj", filter=None, num_probe=None, exact=False):
+        '''
+        :param arg: subject if position is "obj", object if position is "subj"
+        :param filter: keys of predicted arguments that are excluded, e.g., those of known facts
+        :param num_probe: number of clusters searched if an index was built for position (see build_index),
+        defaults to 10% of all clusters
+        :param exact: search exactly even if there is an index
+        :return: list of the (key, score) of the k best predicted arguments, sorted by descending score
+        '''
+        dim = 2 if position == "obj" else 1
+        rel_id = self.vocab_ids(0, [rel])[0]
+        arg_id = self.vocab_ids(3 - dim, [arg])[0]
+        num_candidates = len(self._vocabs[dim])
+        excluded = np.zeros([num_candidates], dtype=np.bool)
+        if filter:
+            index = self._vocab_index(dim)
+            excluded[[index[key] for key in filter if key in index]] = True
+
+        linear = self._linear_query(rel_id, arg_id, position)
+        if linear is not None and position in self._indexes and not exact:
+            name, query, const = linear
+            index = self._indexes[position]
+            if num_probe is None:
+                num_probe = max(1, len(index.centroids) / 10)
+            ids = index.probe(query, num_probe)
+            ids = ids[~excluded[ids]]
+            top_ids, top_scores = _topk(ids, const + self._rows(name, ids).dot(query), k)
+        else:
+            top_ids = np.zeros([0], dtype=np.int64)
+            top_scores = np.zeros([0], dtype=np.float32)
+            for start in xrange(0, num_candidates, BLOCK_SIZE):
+                ids = np.arange(start, min(start + BLOCK_SIZE, num_candidates))
+                ids = ids[~excluded[ids]]
+                if linear is not None:
+                    name, query, const = linear
+                    scores = const + self._rows(name, ids).dot(query)
+                elif position == "obj":
+                    scores = self._score_block(np.repeat(rel_id, len(ids)), np.repeat(arg_id, len(ids)), ids)
+                else:
+                    scores = self._score_block(np.repeat(rel_id, len(ids)), ids, np.repeat(arg_id, len(ids)))
+                top_ids, top_scores = _topk(np.concatenate([top_ids, ids]), np.concatenate([top_scores, scores]), k)
+        vocab = self._vocabs[dim]
+        return [(vocab[i], float(score)) for i, score in zip(top_ids, top_scores)]
+
+
+class DistMultScorer(NumpyScorer):
+    TABLES = ["rel", "subj", "obj"]
+
+    def _score_block(self, rel_ids, subj_ids, obj_ids):
+        return np.sum(self._rows("rel", rel_ids) * self._rows("subj", subj_ids) * self._rows("obj", obj_ids), axis=1)
+
+
+    def _linear_query(self, rel_id, arg_id, position):
+        if position == "obj":
+            return "obj", self._rows("rel", [rel_id])[0] * self._rows("subj", [arg_id])[0], 0.0
+        else:
+            return "subj", self._rows("rel", [rel_id])[0] * self._rows("obj", [arg_id])[0], 0.0
+
+
+class ModelEScorer(NumpyScorer):
+    TABLES = ["rel_s", "rel_o", "subj", "obj"]
+
+    def _score_block(self, rel_ids, subj_ids, obj_ids):
+        return np.sum(self._rows("rel_s", rel_ids) * self._rows("subj", subj_ids) +
+                      self._rows("rel_o", rel_ids) * self._rows("obj", obj_ids), axis=1)
+
+
+    def _linear_query(self, rel_id, arg_id, position):
+        if position == "obj":
+            return "obj", self._rows("rel_o", [rel_id])[0], \
+                   self._rows("rel_s", [rel_id])[0].dot(self._rows("subj", [arg_id])[0])
+        else:
+            return "subj", self._rows("rel_s", [rel_id])[0], \
+                   self._rows("rel_o", [rel_id])[0].dot(self._rows("obj", [arg_id])[0])
+
+
+class ModelFScorer(NumpyScorer):
+    TABLES = ["rel", "tup"]
+
+    def _score_block(self, rel_ids, subj_ids, obj_ids):
+        a = self._arrays
+        tuple_keys = a["tuple_keys"]
+        tuple_ids = kb_index.find_sorted(tuple_keys, kb_index.pack_pairs(subj_ids, obj_ids, int(a["num_args"])))
+        tuple_ids = np.where(tuple_ids >= 0, tuple_ids, len(tuple_keys))
+        return np.sum(self._rows("rel", rel_ids) * self._rows("tup", tuple_ids), axis=1)
+
+
+class ModelOScorer(NumpyScorer):
+    TABLES = ["rel", "tup_rels"]
+
+    def __init__(self, arrays):
+        NumpyScorer.__init__(self, arrays)
+        self._tuple_rels = kb_index.CSRIndex(arrays["tuple_rels_keys"], arrays["tuple_rels_values"],
+                                             arrays["tuple_rels_offsets"])
+
+    def _score_block(self, rel_ids, subj_ids, obj_ids):
+        a = self._arrays
+        if len(rel_ids) == 0:
+            return np.zeros([0])
+        batch_pos, cols, rels, counts = self._tuple_rels.gather(
+            kb_index.pack_pairs(subj_ids, obj_ids, int(a["num_args"])))
+        # the scored relation itself is not observed
+        keep = rels != a["kb_rel_obs_ids"][rel_ids][batch_pos]
+        sparse_indices, sparse_values, _ = kb_index.sparse_features(batch_pos[keep], cols[keep], rels[keep], counts,
+                                                                    int(a["default_value"]))
+        # mean of observed relation embeddings, every triple has at least the default feature
+        num_features = np.bincount(sparse_indices[:, 0], minlength=len(rel_ids))
+        starts = np.cumsum(num_features) - num_features
+        e_tuple_rels = np.add.reduceat(self._rows("tup_rels", sparse_values), starts, axis=0) / num_features[:, None]
+        return np.sum(self._rows("rel", rel_ids) * np.tanh(e_tuple_rels), axis=1)
+
+
+SCORERS = {"DistMult": DistMultScorer, "ModelE": ModelEScorer, "ModelF": ModelFScorer, "ModelO": ModelOScorer}
+
+
+def topk_recall(scorer, queries, k, position="obj", num_probe=None):
+    '''
+    Compares approximate top-k search with the index of scorer for position (see NumpyScorer.build_index) with exact
+    search.
+    :param queries: list of (rel, arg), see NumpyScorer.predict_topk
+    :return: mean recall of the exact top k, seconds per query of exact search, seconds per query of approximate search
+    '''
+    recall = 0.0
+    exact_time = 0.0
+    approx_time = 0.0
+    for rel, arg in queries:
+        start = time.time()
+        exact = scorer.predict_topk(rel, arg, k, position, exact=True)
+        exact_time += time.time() - start
+        start = time.time()
+        approx = scorer.predict_topk(rel, arg, k, position, num_probe=num_probe)
+        approx_time += time.time() - start
+        if exact:
+            recall += len(set(key for key, _ in exact) & set(key for key, _ in approx)) / float(len(exact))
+    num_queries = float(max(1, len(queries)))
+    return recall / num_queries, exact_time / num_queries, approx_time / num_queries
+
+
+class _EvalModel:
+    '''
+    Adapts a scorer to eval.py, which scores triples by the ids of the kb it is given.
+    '''
+
+    def __init__(self, scorer, kb):
+        self._scorer = scorer
+        self._id_maps = [scorer.vocab_ids(dim, kb.get_vocab(dim)) for dim in xrange(3)]
+
+    def score_ids(self, sess, rel_ids, subj_ids, obj_ids):
+        return self._scorer.score_ids(self._id_maps[0][rel_ids], self._id_maps[1][subj_ids],
+                                      self._id_maps[2][obj_ids])
+
+
+if __name__ == "__main__":
+    # Benchmark of reduced precision tables: ranks test triples with the exported float32 scorer and with each
+    # reduced precision and reports MRR deltas. With --ivf_clusters, also reports the recall of approximate top-k
+    # object prediction against exact search.
+    import argparse
+    import os
+    import random
+    import eval
+    from data.load_fb15k237 import load_fb15k, load_fb15k_type_constraints
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scorer", required=True, help="scorer exported in float32, see train.py --export_scorer")
+    parser.add_argument("--fb15k_dir", required=True, help="data dir containing files of fb15k dataset")
+    parser.add_argument("--type_constraint", action="store_true", help="Use type constraints during ranking.")
+    parser.add_argument("--eval_set", default="test", help="valid or test")
+    parser.add_argument("--num_triples", type=int, default=1000, help="Number of sampled triples, 0 for all.")
+    parser.add_argument("--precisions", default="float16,int8", help="comma separated reduced precisions")
+    parser.add_argument("--ivf_clusters", type=int, default=0, help="Number of clusters of the IVF index, 0 to skip "
+                                                                   "the top-k benchmark.")
+    parser.add_argument("--num_probe", type=int, default=None, help="Number of searched clusters.")
+    parser.add_argument("--topk", type=int, default=10, help="k of top-k queries")
+    args = parser.parse_args()
+
+    # every key of the kb without text has an id in scorers trained with or without text
+    kb = load_fb15k(args.fb15k_dir, with_text=False)
+    if args.type_constraint:
+        load_fb15k_type_constraints(kb, os.path.join(args.fb15k_dir, "types"))
+    triples = [f[0] for f in kb.get_all_facts_of_arity(2, args.eval_set)]
+    if 0 < args.num_triples < len(triples):
+        triples = random.Random(1234).sample(triples, args.num_triples)
+    print("Loaded data, evaluating %d triples." % len(triples))
+
+    scorer = load_scorer(args.scorer)
+    base_mrr = None
+    print("precision  table MB     MRR  delta MRR  Top10  time (s)")
+    for precision in ["float32"] + args.precisions.split(","):
+        s = scorer.with_precision(precision)
+        start = time.time()
+        (mrr, top10), _, _ = eval.eval_triples(None, kb, _EvalModel(s, kb), triples)
+        elapsed = time.time() - start
+        if base_mrr is None:
+            base_mrr = mrr
+        print("%9s  %8.1f  %6.4f  %+9.4f  %5.3f  %8.1f" %
+              (precision, s.table_bytes() / 1e6, mrr, mrr - base_mrr, top10, elapsed))
+
+    if args.ivf_clusters > 0:
+        start = time.time()
+        scorer.build_index("obj", args.ivf_clusters)
+        print("Built IVF index with %d clusters in %.1fs." % (args.ivf_clusters, time.time() - start))
+        recall, exact_time, approx_time = topk_recall(scorer, [(rel, subj) for rel, subj, _ in triples], args.topk,
+                                                      "obj", args.num_probe)
+        print("Recall@%d: %.4f, exact: %.2fms per query, approximate: %.2fms per query" %
+              (args.topk, recall, exact_time * 1000, approx_time * 1000))
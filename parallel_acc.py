@@ -0,0 +1,93 @@
+"""Accumulates gradients and loss of full-batch training (--batch_train) in several worker processes, each of which
+holds its own copy of the model graph."""
+import os
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+
+
+def _accumulators(model):
+    return model._acc_gradients + [c for c in model._acc_row_counts if c is not None] + [model._loss]
+
+
+def _work(conn, create_f):
+    model, samplers = create_f()
+    saver = tf.train.Saver(tf.trainable_variables())
+    accumulators = _accumulators(model)
+    with tf.Session() as sess:
+        sess.run(tf.initialize_all_variables())
+        while True:
+            job = conn.recv()
+            if job is None:
+                break
+            ckpt, batches = job
+            saver.restore(sess, ckpt)
+            model.reset_gradients_and_loss(sess)
+            for sampler_idx, pos_idx, seeds in batches:
+                pos, negs = samplers[sampler_idx].get_batch_for(pos_idx, seeds)
+                model.step(sess, pos, negs, "accumulate")
+            conn.send(sess.run(accumulators))
+    conn.close()
+
+
+class ParallelAccumulator:
+    '''
+    Shards the batches of an epoch across worker processes and sums their accumulated gradients and loss into the
+    accumulators of the model of the calling process. Workers must be started before any tf.Session is created
+    in this process, and before samplers that are used by this process (their thread pools do not survive forking).
+    '''
+
+    def __init__(self, num_workers, create_f):
+        '''
+        :param create_f: called once in every worker, returns a model created exactly like the trained model (for
+        batch training) and a list of samplers
+        '''
+        self._conns = []
+        self._workers = []
+        for _ in xrange(num_workers):
+            conn, worker_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_work, args=(worker_conn, create_f))
+            worker.daemon = True
+            worker.start()
+            self._conns.append(conn)
+            self._workers.append(worker)
+        self._dir = tempfile.mkdtemp()
+        self._saver = None
+
+    def _init_ops(self, model):
+        self._saver = tf.train.Saver(tf.trainable_variables())
+        self._accumulators = _accumulators(model)
+        self._acc_inputs = [tf.placeholder(acc.dtype.base_dtype, acc.get_shape()) for acc in self._accumulators]
+        self._add = tf.group(*[acc.assign_add(inp) for acc, inp in zip(self._accumulators, self._acc_inputs)])
+
+    def accumulate(self, sess, model, batches):
+        '''
+        Same as running model.step(sess, pos, negs, "accumulate") for every batch, but in parallel. Sums are
+        computed in a fixed order, so results do not depend on the timing of workers.
+        :param batches: list of (index of sampler, see create_f, positive fact indices, negative seeds),
+        see BatchNegTypeSampler.get_batch_for
+        '''
+        if self._saver is None:
+            self._init_ops(model)
+        ckpt = self._saver.save(sess, os.path.join(self._dir, "params.ckpt"))
+        # contiguous shards keep the order of batches within each worker
+        shard_size = (len(batches) + len(self._conns) - 1) / len(self._conns)
+        for k, conn in enumerate(self._conns):
+            conn.send((ckpt, batches[k * shard_size:(k + 1) * shard_size]))
+        sums = None
+        for conn in self._conns:
+            results = conn.recv()
+            if sums is None:
+                sums = results
+            else:
+                sums = [s + r for s, r in zip(sums, results)]
+        sess.run(self._add, feed_dict=dict(zip(self._acc_inputs, sums)))
+
+    def close(self):
+        for conn in self._conns:
+            conn.send(None)
+        for worker in self._workers:
+            worker.join()
+        shutil.rmtree(self._dir, ignore_errors=True)
@@ -0,0 +1,110 @@
+"""Pipelined training of compositional models: the relations of the next batches are composed in a separate thread,
+while the current batch is scored and updated."""
+import copy
+import random
+import threading
+import time
+import Queue
+import numpy as np
+
+
+def _lane(model):
+    '''
+    :return: shallow copy of model with its own input buffers, which shares graph, variables and composition
+    functions with model
+    '''
+    lane = copy.copy(model)
+    for name, value in vars(model).items():
+        if isinstance(value, np.ndarray):
+            setattr(lane, name, value.copy())
+    lane._feed_dict = dict(model._feed_dict)
+    if hasattr(model, "_models"):
+        lane._models = [_lane(m) for m in model._models]
+    return lane
+
+
+def _comp_functions(model):
+    return [m._comp_model for m in getattr(model, "_models", [model])]
+
+
+class PipelinedTrainer:
+    '''
+    A composer thread samples batches, fills the inputs of one of max_staleness + 1 lanes (copies of the model with
+    their own input buffers) and composes their relations, while the calling thread scores and updates the composed
+    batches in order. A lane is only refilled after its batch was updated, so a batch is composed with parameters
+    that are at most max_staleness updates older than the ones it is updated with.
+    '''
+
+    def __init__(self, sess, model, samplers, sample_text_prob=0.0, max_staleness=1, seed=1234):
+        '''
+        :param samplers: [fact_sampler] or [fact_sampler, text_sampler], only used by the composer thread
+        :param sample_text_prob: probability of sampling a batch from the text sampler
+        :param max_staleness: number of batches that are composed ahead of the updated batch
+        '''
+        assert hasattr(model, "_composition_forward"), "Pipelined training is only possible for compositional models."
+        assert max_staleness >= 1, "max_staleness has to be at least 1."
+        self._sess = sess
+        self._samplers = samplers
+        self._sample_text_prob = sample_text_prob
+        self._rng = random.Random(seed)
+        # the graph must not change while the composer thread runs the session
+        for comp_model in _comp_functions(model):
+            comp_model.build_updates(sess)
+        self._lanes = [_lane(model) for _ in xrange(max_staleness + 1)]
+        self._num_updates = 0
+        # total number of batches sampled from the fact sampler, used for counting epochs
+        self.fact_batches = 0
+
+    def _compose(self, num_steps, composed, free_lanes, stats):
+        try:
+            for t in xrange(num_steps):
+                free_lanes.acquire()
+                start_time = time.time()
+                lane = self._lanes[t % len(self._lanes)]
+                if len(self._samplers) == 1 or self._rng.random() >= self._sample_text_prob:
+                    pos, negs = self._samplers[0].get_batch()
+                    self.fact_batches += 1
+                else:
+                    pos, negs = self._samplers[1].get_batch()
+                feed_dict = lane._dedup_feed_dict(lane._add_batch(pos, negs))
+                version = self._num_updates
+                lane._composition_forward(self._sess)
+                stats["compose_time"] += time.time() - start_time
+                composed.put((lane, feed_dict, version))
+        except Exception as e:
+            composed.put(e)
+
+    def run(self, num_steps):
+        '''
+        Runs num_steps steps. Only batches of these steps are composed ahead, so the model is not used by the
+        composer thread anymore when run returns.
+        :return: dict with "steps", "loss" (summed), "time", "compose_time" (incl. sampling), "update_time",
+        "overlap" (fraction of compose_time hidden behind updates) and "staleness" (max number of updates between
+        composing and updating a batch)
+        '''
+        stats = {"steps": 0, "loss": 0.0, "time": 0.0, "compose_time": 0.0, "update_time": 0.0, "overlap": 0.0,
+                 "staleness": 0}
+        composed = Queue.Queue()
+        free_lanes = threading.Semaphore(len(self._lanes))
+        composer = threading.Thread(target=self._compose, args=(num_steps, composed, free_lanes, stats))
+        composer.daemon = True
+        start_time = time.time()
+        composer.start()
+        for _ in xrange(num_steps):
+            item = composed.get()
+            if isinstance(item, Exception):
+                raise item
+            lane, feed_dict, version = item
+            update_start = time.time()
+            stats["loss"] += lane._update_step(self._sess, feed_dict)
+            stats["update_time"] += time.time() - update_start
+            stats["staleness"] = max(stats["staleness"], self._num_updates - version)
+            self._num_updates += 1
+            stats["steps"] += 1
+            free_lanes.release()
+        composer.join()
+        stats["time"] = time.time() - start_time
+        if stats["compose_time"] > 0:
+            hidden = stats["compose_time"] + stats["update_time"] - stats["time"]
+            stats["overlap"] = min(1.0, max(0.0, hidden / stats["compose_time"]))
+        return stats
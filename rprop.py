@@ -10,7 +10,7 @@ from tensorflow.python.training import optimizer
 
 
 class RPropOptimizer(optimizer.Optimizer):
-    """Optimizer that implements the Adam algorithm."""
+    """Optimizer that implements the iRprop- algorithm."""
 
     def __init__(self, stepsize=0.1, etaplus=1.2, etaminus=0.5, stepsizemax=50.0, stepsizemin=1E-06,
                  use_locking=False, name="RProp"):
@@ -26,51 +26,52 @@ class RPropOptimizer(optimizer.Optimizer):
         :param var_list:
         :return:
         '''
-        # Create the beta1 and beta2 accumulators on the same device as the first
-        # variable.
-
-        # Create slots for the first and second moments.
+        # Create slots for the step sizes and the gradients of the last step.
         for v in var_list:
             self._get_or_make_slot(v, tf.fill(v.get_shape(), self._stepsize), "stepsize", self._name)
-            self._get_or_make_slot(v, tf.zeros([v.get_shape().num_elements()], dtype=tf.float32), "stepmul", self._name)
-            self._get_or_make_slot(v, tf.zeros([v.get_shape().num_elements()], dtype=tf.float32), "delta", self._name)
+            self._get_or_make_slot(v, tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype), "delta", self._name)
+
+    def _irprop_minus(self, grad, last_grad, step):
+        '''
+        Elementwise iRprop-: step sizes grow where the gradient kept its sign and shrink where it flipped, in which
+        case the gradient is also forgotten and no update is made.
+        :return: new step sizes, gradient to remember and update of the variable
+        '''
+        sign = tf.sign(last_grad * grad)
+        grown = tf.cast(tf.greater(sign, 0.0), grad.dtype)
+        flipped = tf.cast(tf.less(sign, 0.0), grad.dtype)
+        stepmul = 1.0 + grown * (self._etaplus - 1.0) + flipped * (self._etaminus - 1.0)
+        new_step = tf.clip_by_value(step * stepmul, self._stepsizemin, self._stepsizemax)
+        new_grad = grad * (1.0 - flipped)
+        return new_step, new_grad, new_step * tf.sign(new_grad)
 
     def _apply_dense(self, grad, var):
         last_grad = self.get_slot(var, "delta")
         step = self.get_slot(var, "stepsize")
-        stepmul = self.get_slot(var, "stepmul")
-
-        grad_flat = tf.reshape(grad, [-1])
-
-        sign = tf.sign(last_grad * grad_flat)
-
-        with tf.control_dependencies([sign]):
-            last_grad = last_grad.assign(grad_flat)
-
-        one_indices = tf.where(tf.equal(sign, 1))
-        m_one_indices = tf.where(tf.equal(sign, -1))
-        zero_indices = tf.where(tf.equal(sign, 0))
 
-        eta_plus_update = tf.cast(one_indices, tf.float32) * 0.0 + self._etaplus
-        zero_update = tf.cast(m_one_indices, tf.float32) * 0.0
-        eta_minus_update = zero_update + self._etaminus
-        one_update = tf.cast(zero_indices, tf.float32) * 0.0 + 1
+        new_step, new_grad, up = self._irprop_minus(grad, last_grad, step)
+        step_a = step.assign(new_step, use_locking=self._use_locking)
+        last_grad_a = last_grad.assign(new_grad, use_locking=self._use_locking)
+        with tf.control_dependencies([step_a, last_grad_a]):
+            var_update = var.assign_sub(up, use_locking=self._use_locking)
 
-        stepmul_up = tf.scatter_update(stepmul, one_indices, eta_plus_update)
-        stepmul_up = tf.scatter_update(stepmul_up, m_one_indices, eta_minus_update)
-        stepmul_up = tf.scatter_update(stepmul_up, zero_indices, one_update)
+        return tf.group(*[var_update, step_a, last_grad_a])
 
-        new_step = step * tf.reshape(stepmul_up, tf.shape(step))
-        new_step = tf.maximum(new_step, self._stepsizemin)
-        new_step = tf.minimum(new_step, self._stepsizemax)
-        step_a = step.assign(new_step)
-
-        last_grad = tf.scatter_update(last_grad, m_one_indices, zero_update)
+    def _apply_sparse(self, grad, var):
+        '''
+        Only rows in grad are updated. Step sizes and last gradients of all other rows are kept as they are, which
+        is equivalent to the dense update for full-batch training, because every epoch touches the same rows.
+        '''
+        last_grad = self.get_slot(var, "delta")
+        step = self.get_slot(var, "stepsize")
 
-        up = new_step * tf.reshape(tf.sign(last_grad), tf.shape(step))
-        var_update = var.assign_sub(up, use_locking=self._use_locking)
+        # rows can occur several times in a gradient, their values have to be summed before reading and writing
+        indices, segments = tf.unique(grad.indices)
+        values = tf.unsorted_segment_sum(grad.values, segments, tf.size(indices))
 
-        return tf.group(*[var_update, step_a])
+        new_step, new_grad, up = self._irprop_minus(values, tf.gather(last_grad, indices), tf.gather(step, indices))
+        step_a = tf.scatter_update(step, indices, new_step, use_locking=self._use_locking)
+        last_grad_a = tf.scatter_update(last_grad, indices, new_grad, use_locking=self._use_locking)
+        var_update = tf.scatter_sub(var, indices, up, use_locking=self._use_locking)
 
-    def _apply_sparse(self, grad, var):
-        raise NotImplementedError("RProp should be used only in batch_mode.")
+        return tf.group(*[var_update, step_a, last_grad_a])
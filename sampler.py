@@ -5,8 +5,12 @@ import multiprocessing
 
 class BatchNegTypeSampler:
 
-    def __init__(self, kb, pos_per_batch, neg_per_pos=200, which_set="train", type_constraint=True):
+    def __init__(self, kb, pos_per_batch, neg_per_pos=200, which_set="train", type_constraint=True, rng=None):
+        '''
+        :param rng: random.Random used for shuffling and seeding negatives, defaults to the global random module
+        '''
         self.kb = kb
+        self._rng = rng if rng is not None else random
         self.pos_per_batch = pos_per_batch
         self.neg_per_pos = neg_per_pos
         self.type_constraint = type_constraint
@@ -76,7 +80,7 @@ class BatchNegTypeSampler:
     # @profile
     def reset(self):
         self.todo_facts = list(xrange(self.num_facts))
-        random.shuffle(self.todo_facts)
+        self._rng.shuffle(self.todo_facts)
         self.todo_facts = self.todo_facts[:-(self.num_facts % self.pos_per_batch)]
         self.count = 0
 
@@ -123,7 +127,7 @@ class BatchNegTypeSampler:
             for _ in xrange(self.neg_per_pos):
                 x = None
                 while not x or x == disallowed or self.kb.contains_fact(True, "train", rel, subj, x):
-                    i = random.randint(0, last)
+                    i = rng.randint(0, last)
                     x = neg_candidates[i]
                     if neg_candidates is not self._objs:  # do not change self._objs, accidental doubles are very rare
                         # remove candidate efficiently from candidates
@@ -153,13 +157,36 @@ class BatchNegTypeSampler:
 
         return neg_triples
 
-    # @profile
-    def get_batch(self, position="both"):
+    def next_pos_indices(self):
+        '''
+        :return: indices of the positive facts of the next batch
+        '''
         if self.end_of_epoch():
             self.reset()
         pos_idx = self.todo_facts[0:self.pos_per_batch]
         self.count += 1
         self.todo_facts = self.todo_facts[self.pos_per_batch::]
+        return pos_idx
+
+    def neg_seeds(self, position="both"):
+        '''
+        :return: seeds for sampling the negatives of each positive example of a batch
+        '''
+        num = self.pos_per_batch*2 if position == "both" else self.pos_per_batch
+        return [self._rng.randint(0, 1000) for _ in xrange(num)]
+
+    # @profile
+    def get_batch(self, position="both"):
+        pos_idx = self.next_pos_indices()
+        return self.get_batch_for(pos_idx, self.neg_seeds(position), position)
+
+    def get_batch_for(self, pos_idx, seeds, position="both"):
+        '''
+        Deterministic given its arguments, so batches can also be sampled elsewhere, e.g., in another process.
+        :param pos_idx: see next_pos_indices
+        :param seeds: see neg_seeds
+        :return: positive and negative triples of the batch
+        '''
         if position == "both":
             pos = [self.facts[pos_idx[i % self.pos_per_batch]] for i in xrange(self.pos_per_batch*2)]
         else:
@@ -170,18 +197,32 @@ class BatchNegTypeSampler:
                 lambda (i, seed): self.__get_neg_examples(pos[i], "obj", random.Random(seed))
                 if i < self.pos_per_batch else
                 self.__get_neg_examples(pos[i], "subj", random.Random(seed)),
-                ((i, random.randint(0, 1000)) for i in xrange(self.pos_per_batch*2)))
+                enumerate(seeds))
 
         if position == "subj":
             negs = self.__pool.map(lambda (fact, seed): self.__get_neg_examples(fact, "subj", random.Random(seed)),
-                                   ((fact, random.randint(0, 1000)) for fact in pos))
+                                   zip(pos, seeds))
 
         if position == "obj":
             negs = self.__pool.map(lambda (fact, seed): self.__get_neg_examples(fact, "obj", random.Random(seed)),
-                                   ((fact, random.randint(0, 1000)) for fact in pos))
+                                   zip(pos, seeds))
 
         return pos, negs
 
+    def get_shared_batch(self, num_shared_neg):
+        '''
+        Batch for training with negatives that are shared by all positives (see AbstractKBScoringModel.step_shared).
+        Negatives are sampled uniformly from all subjects and objects, without type constraints.
+        :return: positive triples, (negative subjects, negative objects)
+        '''
+        pos = [self.facts[i] for i in self.next_pos_indices()]
+        neg_subjs = self._rng.sample(self._subjs, num_shared_neg)
+        neg_objs = self._rng.sample(self._objs, num_shared_neg)
+        return pos, (neg_subjs, neg_objs)
+
+    def get_shared_batch_async(self, num_shared_neg):
+        return self.__pool.apply_async(self.get_shared_batch, (num_shared_neg,))
+
     def get_batch_async(self, position="both"):
         return self.__pool.apply_async(self.get_batch, (position,))
 
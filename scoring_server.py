@@ -0,0 +1,218 @@
+"""Local HTTP scoring service. Concurrent requests are coalesced into batches, so that the fixed overhead of scoring
+(e.g. one sess.run) is paid once per batch instead of once per request."""
+import collections
+import json
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+import Queue
+import numpy as np
+
+
+class _Request:
+
+    def __init__(self, rel_ids, subj_ids, obj_ids):
+        self.ids = (rel_ids, subj_ids, obj_ids)
+        self.size = len(rel_ids)
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.scores = None
+        self.error = None
+
+
+class MicroBatcher:
+    '''
+    Collects requests in a single scoring thread. A batch is scored as soon as it holds batch_size triples or its
+    first request has waited max_latency seconds. Requests with more than batch_size triples are scored alone.
+    '''
+
+    def __init__(self, score_f, batch_size=1024, max_latency=0.005, window=10000):
+        '''
+        :param score_f: function scoring id arrays (rel_ids, subj_ids, obj_ids), e.g., NumpyScorer.score_ids or
+        lambda r, s, o: model.score_ids(sess, r, s, o). It is only called from the scoring thread.
+        :param max_latency: latency budget in seconds for collecting a batch
+        :param window: number of most recent requests and batches that metrics are computed on
+        '''
+        self._score_f = score_f
+        self._batch_size = batch_size
+        self._max_latency = max_latency
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=window)
+        self._fills = collections.deque(maxlen=window)
+        self._num_requests = 0
+        self._num_batches = 0
+        # request that did not fit into the last batch
+        self._pending = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def score_ids(self, rel_ids, subj_ids, obj_ids):
+        '''
+        Blocks until the triples are scored as part of a batch.
+        :return: scores of the triples
+        '''
+        request = _Request(np.asarray(rel_ids, dtype=np.int64), np.asarray(subj_ids, dtype=np.int64),
+                           np.asarray(obj_ids, dtype=np.int64))
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.scores
+
+    def _next_batch(self):
+        if self._pending is not None:
+            batch = [self._pending]
+            self._pending = None
+        else:
+            batch = [self._queue.get()]
+        if batch[0] is None:
+            return None
+        size = batch[0].size
+        deadline = batch[0].arrival + self._max_latency
+        while size < self._batch_size:
+            timeout = deadline - time.time()
+            try:
+                request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if request is None:
+                # closing, score the current batch first
+                self._queue.put(None)
+                break
+            if size + request.size > self._batch_size:
+                self._pending = request
+                break
+            batch.append(request)
+            size += request.size
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            size = sum(r.size for r in batch)
+            try:
+                scores = self._score_f(*[np.concatenate([r.ids[k] for r in batch]) for k in xrange(3)])
+                offset = 0
+                for r in batch:
+                    r.scores = np.asarray(scores[offset:offset + r.size])
+                    offset += r.size
+            except Exception as e:
+                for r in batch:
+                    r.error = e
+            end = time.time()
+            with self._lock:
+                self._num_batches += 1
+                self._num_requests += len(batch)
+                self._fills.append(min(1.0, size / float(self._batch_size)))
+                self._latencies.extend(end - r.arrival for r in batch)
+            for r in batch:
+                r.done.set()
+
+    def metrics(self):
+        '''
+        :return: dict with number of requests and batches, p50 and p99 request latency in ms and mean batch fill
+        '''
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            fills = np.array(self._fills)
+            num_requests, num_batches = self._num_requests, self._num_batches
+        return {"requests": num_requests,
+                "batches": num_batches,
+                "latency_p50_ms": float(np.percentile(latencies, 50)) if len(latencies) > 0 else 0.0,
+                "latency_p99_ms": float(np.percentile(latencies, 99)) if len(latencies) > 0 else 0.0,
+                "batch_fill": float(np.mean(fills)) if len(fills) > 0 else 0.0}
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def _send(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._send(200, self.server.batcher.metrics())
+        else:
+            self._send(404, {"error": "unknown path %s" % self.path})
+
+    def do_POST(self):
+        if self.path != "/score":
+            self._send(404, {"error": "unknown path %s" % self.path})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader("Content-Length", 0))))
+            ids = np.array([self.server.get_ids_f(*t) for t in request["triples"]], dtype=np.int64).reshape([-1, 3])
+        except (ValueError, KeyError, TypeError) as e:
+            self._send(400, {"error": "invalid request: %s" % e})
+            return
+        try:
+            scores = self.server.batcher.score_ids(ids[:, 0], ids[:, 1], ids[:, 2])
+        except Exception as e:
+            self._send(500, {"error": "scoring failed: %s" % e})
+            return
+        self._send(200, {"scores": [float(s) for s in scores]})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ScoringServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    POST /score with {"triples": [[rel, subj, obj], ...]} answers {"scores": [...]}, GET /metrics answers the metrics
+    of the MicroBatcher. Every connection is handled in its own thread, which waits for the batch of its request.
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, get_ids_f, score_f, batch_size=1024, max_latency=0.005):
+        '''
+        :param address: (host, port)
+        :param get_ids_f: maps the keys of a triple to ids, e.g., KB.get_ids or NumpyScorer.get_ids
+        :param score_f: see MicroBatcher
+        '''
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+        self.get_ids_f = get_ids_f
+        self.batcher = MicroBatcher(score_f, batch_size, max_latency)
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self.batcher.close()
+
+
+if __name__ == "__main__":
+    # Serves a scorer exported with train.py --export_scorer. A trained tensorflow model can be served the same way
+    # with ScoringServer(address, kb.get_ids, lambda r, s, o: model.score_ids(sess, r, s, o)).
+    import argparse
+    import np_scoring
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scorer", required=True, help="exported scorer, see train.py --export_scorer")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--batch_size", type=int, default=1024, help="Max number of triples scored at once.")
+    parser.add_argument("--max_latency_ms", type=float, default=5.0, help="Max time a request waits for its batch "
+                                                                          "to fill up.")
+    args = parser.parse_args()
+
+    scorer = np_scoring.load_scorer(args.scorer)
+    server = ScoringServer((args.host, args.port), scorer.get_ids, scorer.score_ids, args.batch_size,
+                           args.max_latency_ms / 1000.0)
+    print("Serving on %s:%d" % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,59 @@
+"""Optimizers which only touch the rows of embedding tables that are present in sparse gradients."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+
+class LazyAdamOptimizer(tf.train.AdamOptimizer):
+    """
+    Adam, which decays and updates moments only for the rows of a variable that occur in its IndexedSlices
+    gradient instead of for the whole variable. Dense gradients are handled exactly like Adam.
+    """
+
+    def __init__(self, learning_rate=0.001, beta1=0.9, beta2=0.999, epsilon=1e-8,
+                 use_locking=False, name="LazyAdam"):
+        super(LazyAdamOptimizer, self).__init__(learning_rate, beta1, beta2, epsilon, use_locking, name)
+
+    def _apply_sparse(self, grad, var):
+        dtype = var.dtype.base_dtype
+        beta1_power = tf.cast(self._beta1_power, dtype)
+        beta2_power = tf.cast(self._beta2_power, dtype)
+        lr_t = tf.cast(self._lr_t, dtype)
+        beta1_t = tf.cast(self._beta1_t, dtype)
+        beta2_t = tf.cast(self._beta2_t, dtype)
+        epsilon_t = tf.cast(self._epsilon_t, dtype)
+        lr = lr_t * tf.sqrt(1 - beta2_power) / (1 - beta1_power)
+
+        # rows can occur several times in a gradient, their values have to be summed before reading and writing
+        indices, segments = tf.unique(grad.indices)
+        values = tf.unsorted_segment_sum(grad.values, segments, tf.size(indices))
+
+        m = self.get_slot(var, "m")
+        m_t = beta1_t * tf.gather(m, indices) + (1 - beta1_t) * values
+        m_update = tf.scatter_update(m, indices, m_t, use_locking=self._use_locking)
+
+        v = self.get_slot(var, "v")
+        v_t = beta2_t * tf.gather(v, indices) + (1 - beta2_t) * tf.square(values)
+        v_update = tf.scatter_update(v, indices, v_t, use_locking=self._use_locking)
+
+        var_update = tf.scatter_sub(var, indices, lr * m_t / (tf.sqrt(v_t) + epsilon_t),
+                                    use_locking=self._use_locking)
+        return tf.group(*[var_update, m_update, v_update])
+
+
+def create_optimizer(optimizer, learning_rate):
+    '''
+    :param optimizer: "Adam", "LazyAdam" or "Adagrad". Adagrad updates only the rows of sparse gradients as well.
+    :param learning_rate: float or tensor
+    :return: optimizer for non-batch training
+    '''
+    if optimizer == "Adam":
+        return tf.train.AdamOptimizer(learning_rate, beta1=0.0)
+    elif optimizer == "LazyAdam":
+        return LazyAdamOptimizer(learning_rate, beta1=0.0)
+    elif optimizer == "Adagrad":
+        return tf.train.AdagradOptimizer(learning_rate)
+    else:
+        raise NameError("There is no optimizer %s. Possible values are 'Adam', 'LazyAdam', 'Adagrad'." % optimizer)
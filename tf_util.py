@@ -9,4 +9,13 @@ def batch_dot(t1, t2):
 
 def _clip_by_value(gradients, min_value, max_value):
     # clipping would break IndexedSlices and therefore sparse updates, because they get converted to tensors
-    return [tf.clip_by_value(g, min_value, max_value) if isinstance(g, ops.IndexedSlices) else g for g in gradients]
\ No newline at end of file
+    return [tf.clip_by_value(g, min_value, max_value) if isinstance(g, ops.IndexedSlices) else g for g in gradients]
+
+def accumulated_rows(acc, row_counts):
+    '''
+    :param acc: accumulated gradient of an embedding table
+    :param row_counts: vector with the number of gradients accumulated for each row of acc
+    :return: IndexedSlices of all rows of acc for which a gradient was accumulated
+    '''
+    rows = tf.reshape(tf.where(tf.greater(row_counts, 0.0)), [-1])
+    return tf.IndexedSlices(tf.gather(acc, rows), rows)
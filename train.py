@@ -3,11 +3,17 @@ import os
 import time
 from data.load_fb15k237 import load_fb15k, load_fb15k_type_constraints, split_relations
 from sampler import *
-from eval import eval_triples
+from eval import eval_triples, sample_eval_candidates, eval_triples_sampled
+from eval_daemon import *
 from model import *
 from model.comp_models import *
 import sys
 from kb import subsample_kb
+from kb_index import KBIndexCache
+from parallel_acc import ParallelAccumulator
+from hogwild import HogwildTrainer
+from pipeline import PipelinedTrainer
+import np_scoring
 import shutil
 import json
 from tensorflow.models.rnn.rnn_cell import *
@@ -44,6 +50,34 @@ tf.app.flags.DEFINE_string("valid_mode", "a", "[a,t,nt] are possible. a- validat
                                               "t- validate only on triples with text mentions, "
                                               "nt- validate only on triples without text mentions")
 tf.app.flags.DEFINE_string("composition", None, "'LSTM', 'GRU', 'RNN', 'BoW', 'BiLSTM', 'BiGRU', 'BiRNN'")
+tf.app.flags.DEFINE_integer("approx_valid_candidates", 0, "If > 0, validate approximately by ranking against this many "
+                                                         "fixed, randomly sampled candidates per query. "
+                                                         "Final test is always exact.")
+tf.app.flags.DEFINE_integer("async_valid_timeout", 600, "Seconds to wait for eval_daemon.py to validate the last "
+                                                        "checkpoint after training with --async_valid.")
+tf.app.flags.DEFINE_boolean("async_valid", False, "Only write checkpoints and let eval_daemon.py validate them "
+                                                  "in a separate process. Early stopping uses its results.")
+tf.app.flags.DEFINE_string("optimizer", "Adam", "'Adam', 'LazyAdam' or 'Adagrad'. LazyAdam and Adagrad only update "
+                                               "embeddings of the current batch. Ignored for batch training.")
+tf.app.flags.DEFINE_integer("batch_workers", 0, "Number of processes accumulating gradients in parallel during "
+                                                "batch training. 0 accumulates in the training process.")
+tf.app.flags.DEFINE_integer("hogwild_threads", 0, "If > 0, train with this many threads that update the model "
+                                                   "concurrently without locking (not for batch training or "
+                                                   "compositional models).")
+tf.app.flags.DEFINE_integer("pipeline_staleness", 0, "If > 0, compose the relations of up to this many next batches "
+                                                      "in a separate thread while the current batch is updated "
+                                                      "(compositional models only, not for batch training).")
+tf.app.flags.DEFINE_integer("num_shared_neg", 0, "If > 0, score all positives of a batch against this many shared "
+                                                  "negative subjects and objects instead of num_neg own negatives "
+                                                  "(only DistMult and ModelE).")
+tf.app.flags.DEFINE_boolean("export_scorer", False, "Export the best model to scorer.npz in save_dir for scoring "
+                                                   "with np_scoring (DistMult, ModelE, ModelF and ModelO only).")
+tf.app.flags.DEFINE_string("export_precision", "float32", "Storage of exported embedding tables: float32, float16 or "
+                                                          "int8 (quantized per row).")
+tf.app.flags.DEFINE_string("index_cache", None, "File in which indexes derived from the kb are stored and reused "
+                                                "by later runs on the same kb.")
+tf.app.flags.DEFINE_integer("load_workers", 0, "If > 0, parse the dataset files in chunks in this many processes and "
+                                               "add all triples to the kb at once.")
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -53,6 +87,20 @@ if "," in FLAGS.model:
 FLAGS.observed_sets = FLAGS.observed_sets.split(",")
 
 assert (not FLAGS.batch_train or FLAGS.ckpt_its <= -1), "Do not define checkpoint iterations when doing batch training."
+assert (not FLAGS.batch_train or FLAGS.hogwild_threads <= 0), "Hogwild training is not possible with batch training."
+assert (FLAGS.hogwild_threads <= 0 or not FLAGS.composition), \
+    "Hogwild training is not possible for compositional models."
+assert (FLAGS.num_shared_neg <= 0 or (not FLAGS.batch_train and FLAGS.hogwild_threads <= 0)), \
+    "Shared negatives are not possible with batch or hogwild training."
+assert (FLAGS.pipeline_staleness <= 0 or (FLAGS.composition and not FLAGS.batch_train and FLAGS.hogwild_threads <= 0
+                                          and FLAGS.num_shared_neg <= 0)), \
+    "Pipelined training is only possible for compositional models without batch, hogwild or shared negative training."
+# checked before training, the scorer is only exported at the end of the run
+assert (not FLAGS.export_scorer or (not FLAGS.composition and not isinstance(FLAGS.model, list)
+                                    and FLAGS.model in np_scoring.SCORERS)), \
+    "Export is only supported for %s." % ", ".join(sorted(np_scoring.SCORERS))
+assert (not FLAGS.export_scorer or FLAGS.export_precision in np_scoring.PRECISIONS), \
+    "export_precision must be one of %s." % ", ".join(np_scoring.PRECISIONS)
 
 if FLAGS.batch_train:
     print("Batch training!")
@@ -60,7 +108,7 @@ if FLAGS.batch_train:
 random.seed(FLAGS.random_seed)
 tf.set_random_seed(FLAGS.random_seed)
 
-kb = load_fb15k(FLAGS.fb15k_dir, with_text=not FLAGS.kb_only)
+kb = load_fb15k(FLAGS.fb15k_dir, with_text=not FLAGS.kb_only, num_workers=FLAGS.load_workers)
 if FLAGS.subsample_kb > 0:
     kb = subsample_kb(kb, FLAGS.subsample_kb)
 
@@ -68,6 +116,9 @@ if FLAGS.type_constraint:
     print("Loading type constraints...")
     load_fb15k_type_constraints(kb, os.path.join(FLAGS.fb15k_dir, "types"))
 
+if FLAGS.index_cache:
+    kb.index_cache = KBIndexCache(kb, FLAGS.index_cache)
+
 num_kb = 0
 num_text = 0
 
@@ -80,9 +131,32 @@ for f in kb.get_all_facts():
 print("Loaded data. %d kb triples. %d text_triples." % (num_kb, num_text))
 batch_size = (FLAGS.num_neg+1) * FLAGS.pos_per_batch * 2  # x2 because subject and object loss training
 
-fact_sampler = BatchNegTypeSampler(kb, FLAGS.pos_per_batch, which_set="train", neg_per_pos=FLAGS.num_neg, type_constraint=FLAGS.type_constraint)
+
+def create_samplers(rng=None):
+    samplers = [BatchNegTypeSampler(kb, FLAGS.pos_per_batch, which_set="train", neg_per_pos=FLAGS.num_neg,
+                                    type_constraint=FLAGS.type_constraint, rng=rng)]
+    if not FLAGS.kb_only:
+        samplers.append(BatchNegTypeSampler(kb, FLAGS.pos_per_batch, which_set="train_text",
+                                            neg_per_pos=FLAGS.num_neg, type_constraint=False, rng=rng))
+    return samplers
+
+
+def create_train_model():
+    return create_model(kb, FLAGS.size, batch_size, num_neg=FLAGS.num_neg, learning_rate=FLAGS.learning_rate,
+                        l2_lambda=FLAGS.l2_lambda, is_batch_training=FLAGS.batch_train, type=FLAGS.model,
+                        observed_sets=FLAGS.observed_sets, composition=FLAGS.composition,
+                        optimizer=FLAGS.optimizer, num_shared_neg=FLAGS.num_shared_neg)
+
+acc_workers = None
+if FLAGS.batch_train and FLAGS.batch_workers > 0:
+    # workers have to be forked before any session or sampler thread pool exists in this process
+    acc_workers = ParallelAccumulator(FLAGS.batch_workers, lambda: (create_train_model(), create_samplers()))
+    print("Started %d gradient accumulation workers." % FLAGS.batch_workers)
+
+samplers = create_samplers()
+fact_sampler = samplers[0]
 if not FLAGS.kb_only:
-    text_sampler = BatchNegTypeSampler(kb, FLAGS.pos_per_batch, which_set="train_text", neg_per_pos=FLAGS.num_neg, type_constraint=False)
+    text_sampler = samplers[1]
 print("Created Samplers.")
 
 train_dir = os.path.join(FLAGS.save_dir, "train")
@@ -93,6 +167,35 @@ subsample_validation = map(lambda x: x[0], kb.get_all_facts_of_arity(2, "valid")
 if len(subsample_validation) > 5000:
     subsample_validation = random.sample(subsample_validation, 5000)
 
+if FLAGS.approx_valid_candidates > 0:
+    print("Sampling %d validation candidates per query..." % FLAGS.approx_valid_candidates)
+    validation_queries = sample_eval_candidates(kb, subsample_validation, FLAGS.approx_valid_candidates,
+                                                seed=FLAGS.random_seed)
+
+if FLAGS.async_valid:
+    if not os.path.exists(train_dir):
+        os.makedirs(train_dir)
+    if os.path.exists(os.path.join(train_dir, DONE_FILE)):
+        os.remove(os.path.join(train_dir, DONE_FILE))
+    with open(os.path.join(FLAGS.save_dir, CONFIG_FILE), 'w') as f:
+        f.write(json.dumps(FLAGS.__flags, sort_keys=True, indent=2, separators=(',', ': ')))
+    write_triples(os.path.join(FLAGS.save_dir, VALID_FILE), subsample_validation)
+    metrics_file = os.path.join(FLAGS.save_dir, METRICS_FILE)
+    num_records = 0
+# newest checkpoint written for validation by eval_daemon.py
+last_ckpt = None
+
+
+def valid_mrr(mrr_a, mrr_t, mrr_nt):
+    if FLAGS.valid_mode == "a":
+        return mrr_a
+    elif FLAGS.valid_mode == "t":
+        return mrr_t
+    elif FLAGS.valid_mode == "nt":
+        return mrr_nt
+    else:
+        raise ValueError("valid_mode flag must be either 'a','t' or 'nt'")
+
 
 if FLAGS.ckpt_its <= 0:
     print "Setting checkpoint iteration to size of whole epoch."
@@ -100,17 +203,16 @@ if FLAGS.ckpt_its <= 0:
 
 with tf.Session() as sess:
     print "Creating model ..."
-    model = create_model(kb, FLAGS.size, batch_size, num_neg=FLAGS.num_neg, learning_rate=FLAGS.learning_rate,
-                         l2_lambda=FLAGS.l2_lambda, is_batch_training=FLAGS.batch_train, type=FLAGS.model,
-                         observed_sets=FLAGS.observed_sets, composition=FLAGS.composition)
+    model = create_train_model()
 
     print "Created model: " + model.name()
 
-    if os.path.exists(train_dir) and any("ckpt" in x for x in os.listdir(train_dir)):
-        newest = max(map(lambda x: os.path.join(train_dir, x),
-                         filter(lambda x: ".ckpt" in x, os.listdir(train_dir))), key=os.path.getctime)
+    if list_checkpoints(train_dir):
+        newest = list_checkpoints(train_dir)[-1]
         print "Loading from checkpoint " + newest
         model.saver.restore(sess, newest)
+        if hasattr(model, "reset_composition_cache"):
+            model.reset_composition_cache()
     else:
         if not os.path.exists(train_dir):
             os.makedirs(train_dir)
@@ -133,24 +235,86 @@ with tf.Session() as sess:
     checkpoint_path = os.path.join(train_dir, "model.ckpt")
 
     end_of_epoch = False
-    def sample_next_batch():
+    def next_sampler_idx():
         if FLAGS.kb_only or random.random() >= FLAGS.sample_text_prob:
-            return fact_sampler.get_batch_async()
+            return 0
         else:
-            return text_sampler.get_batch_async()
+            return 1
 
-    next_batch = sample_next_batch()
+    def next_batch_async():
+        sampler = samplers[next_sampler_idx()]
+        if FLAGS.num_shared_neg > 0:
+            return sampler.get_shared_batch_async(FLAGS.num_shared_neg)
+        else:
+            return sampler.get_batch_async()
+
+    hogwild = None
+    pipeline = None
+    if FLAGS.hogwild_threads > 0:
+        # every thread gets its own sampler stream
+        hogwild = HogwildTrainer(sess, model, kb,
+                                 [create_samplers(random.Random(FLAGS.random_seed + k))
+                                  for k in xrange(FLAGS.hogwild_threads)],
+                                 0.0 if FLAGS.kb_only else FLAGS.sample_text_prob, FLAGS.random_seed)
+    elif FLAGS.pipeline_staleness > 0:
+        pipeline = PipelinedTrainer(sess, model, samplers, 0.0 if FLAGS.kb_only else FLAGS.sample_text_prob,
+                                    FLAGS.pipeline_staleness, FLAGS.random_seed)
+    elif acc_workers is None:
+        next_batch = next_batch_async()
+    else:
+        epoch_batches = []
 
     while FLAGS.max_iterations < 0 or i < FLAGS.max_iterations:
         i += 1
         start_time = time.time()
-        pos, negs = next_batch.get()
-        end_of_epoch = fact_sampler.end_of_epoch()
-        current_ct = fact_sampler.count
-        # already fetch next batch parallel to running model
-        next_batch = sample_next_batch()
-
-        loss += model.step(sess, pos, negs, mode)
+        if hogwild is not None or pipeline is not None:
+            # threads run the steps of a whole checkpoint interval at once
+            num_steps = FLAGS.ckpt_its
+            if FLAGS.max_iterations >= 0:
+                num_steps = min(num_steps, FLAGS.max_iterations - i + 1)
+            i += num_steps - 1
+            print ""
+            if hogwild is not None:
+                stats = hogwild.run(num_steps)
+                for k, st in enumerate(stats):
+                    print "Thread %d: %d steps, %.2f steps/sec, loss %.3f" % \
+                          (k, st["steps"], st["steps"] / max(st["time"], 1e-6), st["loss"] / max(st["steps"], 1))
+                loss += sum(st["loss"] for st in stats)
+                fact_batches = hogwild.fact_batches
+            else:
+                st = pipeline.run(num_steps)
+                print "Pipeline: %.2f steps/sec, compose %.1fs, update %.1fs, %.0f%% of composition overlapped, " \
+                      "staleness %d" % (st["steps"] / max(st["time"], 1e-6), st["compose_time"], st["update_time"],
+                                        100 * st["overlap"], st["staleness"])
+                loss += st["loss"]
+                fact_batches = pipeline.fact_batches
+            current_ct = fact_batches % fact_sampler.epoch_size
+            if fact_batches / fact_sampler.epoch_size > e:
+                e = fact_batches / fact_sampler.epoch_size
+                print "Epoch %d done!" % e
+        elif acc_workers is None:
+            pos, negs = next_batch.get()
+            end_of_epoch = fact_sampler.end_of_epoch()
+            current_ct = fact_sampler.count
+            # already fetch next batch parallel to running model
+            next_batch = next_batch_async()
+
+            if FLAGS.num_shared_neg > 0:
+                (neg_subjs, neg_objs) = negs
+                loss += model.step_shared(sess, pos, neg_subjs, neg_objs, mode)
+            else:
+                loss += model.step(sess, pos, negs, mode)
+        else:
+            # only choose the facts of each batch, workers sample negatives and accumulate the whole epoch at once
+            sampler_idx = next_sampler_idx()
+            epoch_batches.append((sampler_idx, samplers[sampler_idx].next_pos_indices(),
+                                  samplers[sampler_idx].neg_seeds()))
+            end_of_epoch = fact_sampler.end_of_epoch()
+            current_ct = fact_sampler.count
+            if end_of_epoch:
+                acc_workers.accumulate(sess, model, epoch_batches)
+                epoch_batches = []
+                fact_sampler.reset()
         step_time += (time.time() - start_time)
 
         sys.stdout.write("\r%.1f%% Loss: %.3f" %
@@ -182,18 +346,38 @@ with tf.Session() as sess:
             step_time, loss = 0.0, 0.0
             valid_loss = 0.0
 
+            if FLAGS.async_valid:
+                # validation is done by eval_daemon.py, only look at the results that are available by now
+                last_ckpt = model.saver.save(sess, checkpoint_path, global_step=model.global_step)
+                print "Saved checkpoint %s for validation." % last_ckpt
+                stop = False
+                records = read_metrics(metrics_file)
+                for record in records[num_records:]:
+                    num_records += 1
+                    if record.get("skipped"):
+                        continue
+                    mrr = valid_mrr(record["mrr"], record["mrr_wt"], record["mrr_nt"])
+                    print "Validation MRR of %s: %.3f" % (record["path"], mrr)
+                    if e >= 1 and len(previous_mrrs) > 2 and mrr <= min(previous_mrrs[-2:])+1e-4:
+                        stop = True
+                        break
+                    previous_mrrs.append(mrr)
+                    mrr2modelpath[mrr] = "%s-%d" % (checkpoint_path, record["global_step"])
+                print "####################################"
+                if stop:
+                    print "Stop learning!"
+                    break
+                continue
+
             # Run evals on development set and print their perplexity.
             print "########## Validation ##############"
-            (mrr_a, _), (mrr_t, _), (mrr_nt, _) = eval_triples(sess, kb, model, subsample_validation, verbose=True)
-
-            if FLAGS.valid_mode == "a":
-                mrr = mrr_a
-            elif FLAGS.valid_mode == "t":
-                mrr = mrr_t
-            elif FLAGS.valid_mode == "nt":
-                mrr = mrr_nt
+            if FLAGS.approx_valid_candidates > 0:
+                (mrr_a, _, _), (mrr_t, _, _), (mrr_nt, _, _) = \
+                    eval_triples_sampled(sess, kb, model, validation_queries, verbose=True)
             else:
-                raise ValueError("valid_mode flag must be either 'a','t' or 'nt'")
+                (mrr_a, _), (mrr_t, _), (mrr_nt, _) = eval_triples(sess, kb, model, subsample_validation, verbose=True)
+
+            mrr = valid_mrr(mrr_a, mrr_t, mrr_nt)
 
             if e >= 1 and len(previous_mrrs) > 2 and mrr <= min(previous_mrrs[-2:])+1e-4:
                 print "Stop learning!"
@@ -208,12 +392,51 @@ with tf.Session() as sess:
             mrr2modelpath[mrr] = path
             print "####################################"
 
-    best_valid_mrr = max(previous_mrrs[-5:])
-    print("Restore model to best on validation, with MRR: %.3f" % best_valid_mrr)
-    model.saver.restore(sess, mrr2modelpath[best_valid_mrr])
-    model_name = mrr2modelpath[best_valid_mrr].split("/")[-1]
-    shutil.copyfile(mrr2modelpath[best_valid_mrr], os.path.join(FLAGS.save_dir, model_name))
+    if FLAGS.async_valid:
+        open(os.path.join(train_dir, DONE_FILE), 'w').close()
+        print "Waiting for evaluation daemon to validate last checkpoint..."
+        records = read_metrics(metrics_file)
+        # paths of the daemon might be spelled differently, so checkpoints are identified by their global step
+        last_step = checkpoint_step(last_ckpt) if last_ckpt is not None else None
+        wait_start = time.time()
+        while last_step is not None and all(r["global_step"] != last_step for r in records):
+            if time.time() - wait_start > FLAGS.async_valid_timeout:
+                print "Evaluation daemon did not validate %s in time, using the results so far." % last_ckpt
+                break
+            time.sleep(5)
+            records = read_metrics(metrics_file)
+        for record in records[num_records:]:
+            if record.get("skipped"):
+                continue
+            mrr = valid_mrr(record["mrr"], record["mrr_wt"], record["mrr_nt"])
+            previous_mrrs.append(mrr)
+            mrr2modelpath[mrr] = "%s-%d" % (checkpoint_path, record["global_step"])
+
+    if acc_workers is not None:
+        acc_workers.close()
+
+    best_mrrs = previous_mrrs[-5:]
+    if FLAGS.async_valid:
+        # the daemon might have validated checkpoints that the saver of this process has removed by now
+        best_mrrs = [m for m in best_mrrs if os.path.exists(mrr2modelpath[m])]
+    if best_mrrs:
+        best_valid_mrr = max(best_mrrs)
+        best_path = mrr2modelpath[best_valid_mrr]
+        print("Restore model to best on validation, with MRR: %.3f" % best_valid_mrr)
+    else:
+        best_path = last_ckpt or model.saver.save(sess, checkpoint_path, global_step=model.global_step)
+        print("No validated checkpoint left, restore model to last checkpoint.")
+    model.saver.restore(sess, best_path)
+    if hasattr(model, "reset_composition_cache"):
+        model.reset_composition_cache()
+    model_name = best_path.split("/")[-1]
+    shutil.copyfile(best_path, os.path.join(FLAGS.save_dir, model_name))
+    if FLAGS.export_scorer:
+        np_scoring.export(sess, kb, model, os.path.join(FLAGS.save_dir, "scorer.npz"), FLAGS.export_precision)
+        print "Exported scorer to " + os.path.join(FLAGS.save_dir, "scorer.npz")
     print "########## Test ##############"
+    if hasattr(model, "precompute_compositions"):
+        model.precompute_compositions(sess)
     (mrr, top10), (mrr_wt, top10_wt), (mrr_nt, top10_nt) = eval_triples(sess, kb, model, map(lambda x: x[0], kb.get_all_facts_of_arity(2, "test")), verbose=True)
     with open(os.path.join(FLAGS.save_dir, "result.txt"), 'w') as f:
         f.write("best model: %s\n\nMRR: %.3f\nHits10: %.3f\n\n" % (model_name, mrr, top10))